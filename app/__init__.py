@@ -1,41 +1,267 @@
-from flask import Flask, render_template, request, redirect, flash, send_file
-from .env import DB_URL, convert
+from flask import (
+    Flask,
+    stream_with_context,
+    render_template,
+    request,
+    redirect,
+    flash,
+    send_file,
+    jsonify,
+    make_response,
+    Response,
+)
+from .env import (
+    DB_URL,
+    bucket,
+    convert,
+    converter,
+    PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    SEARCH_BACKEND,
+    SEARCH_INDEX_TTL,
+    SLIDES_CACHE_SIZE,
+    SLIDES_CACHE_TTL,
+    SHEET_CACHE_DIR,
+    SHEET_CACHE_BYTES,
+    SHEET_MUSIC_DELIVERY,
+    JOBS_BACKEND,
+    JOB_WORKERS,
+    JOB_MAX_ATTEMPTS,
+    ASYNC_UPLOADS,
+    PREVIEW_DIR,
+    PREVIEW_WORKERS,
+    QUERY_COUNTER,
+    OFFLINE,
+    SHEET_MUSIC_DIR,
+)
 from .utils import (
     get_lyrics,
     clean_arrangement,
     allowed_file,
     lyrics_plaintext,
     clean_lyrics,
+    keyset_page,
+    parse_ids,
+    parse_arrangements,
+    slide_data,
+    song_dict,
+    content_disposition,
+)
+from .search import song_index
+from .db_search import (
+    create_search_tables,
+    sync_songs,
+    unsync_songs,
+    search_songs,
+)
+from .romanize import romanize
+from .cache import RenderCache
+from .bundle import render_bundle, write_bundle
+from .s3 import (
+    s3client,
+    s3ul_dedup,
+    s3del_many,
+    s3list,
+    s3download_many,
+    presigned_urls,
+)
+from .sheet_cache import SheetMusicCache, CHUNK_SIZE
+from .importer import (
+    FORMATS,
+    ImportReport,
+    guess_format,
+    read_records,
+    validate_record,
 )
-from sqlalchemy.dialects.postgresql import JSON
+from .exporter import (
+    CONTENT_TYPES,
+    EXTENSIONS,
+    export_records,
+    format_for,
+    gzip_chunks,
+)
+from .mirror import OVERLAP, Mirror, http_fetch
+from .querycount import QueryCounter, format_counts
+from .jobs import JobQueue, MemoryJobStore, DatabaseJobStore
+from .previews import (
+    PreviewStore,
+    preview_key,
+    is_content_key,
+    available as previews_available,
+)
+from sqlalchemy import JSON
+from sqlalchemy.dialects import postgresql
+from botocore.exceptions import ClientError
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy import func
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event, inspect, text
+from io import BytesIO
 from pathlib import Path
-from hanziconv import HanziConv
+from itertools import islice
+from datetime import datetime, timedelta, timezone
 
-import pinyin
-import uuid
-import boto3
-import os
+import click
 import logging as log
+import re
+import secrets
+import time
 
 # Start app
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = DB_URL
-db = SQLAlchemy(app)
+# Objects stay loaded after a commit, so that a route can render the song it
+# just saved without selecting it again.
+db = SQLAlchemy(app, session_options={"expire_on_commit": False})
+
+# Per-request SQL statement counts, in debug mode. The listener is always
+# installed, since debug mode may be switched on after import (see
+# `run.py`); it does nothing unless a count has been started.
+query_counter = QueryCounter()
+with app.app_context():
+    query_counter.install(db.engine)
+
+
+def counting_queries():
+    return app.debug or QUERY_COUNTER
+
+
+@app.before_request
+def start_query_count():
+    if counting_queries():
+        query_counter.start()
+
+
+@app.before_request
+def read_only_when_offline():
+    """
+    Refuses every change in offline mode: the snapshot is a copy, and would
+    be overwritten by the next one.
+
+    The song page's slides and export buttons post the form, but only to
+    preview it; they do not save.
+    """
+    if (
+        OFFLINE
+        and request.method not in ("GET", "HEAD", "OPTIONS")
+        and request.endpoint not in ("slides", "export_lyrics")
+    ):
+        return Response("This is a read-only offline copy.", status=405)
+
+
+@app.after_request
+def report_query_count(response):
+    if counting_queries():
+        counts = query_counter.stop()
+        response.headers["X-Query-Count"] = format_counts(counts)
+        log.debug(f"{request.method} {request.path}: {dict(counts)}")
+    return response
+
+
+# Rendered slides, keyed by song id.
+slides_cache = RenderCache(maxsize=SLIDES_CACHE_SIZE, ttl=SLIDES_CACHE_TTL)
+
+# Sheet music PDFs downloaded from s3.
+sheet_cache = SheetMusicCache(SHEET_CACHE_DIR, SHEET_CACHE_BYTES)
+
+# First-page previews of the sheet music.
+if OFFLINE:
+    preview_store = PreviewStore(
+        Path(SHEET_MUSIC_DIR) / "previews", sheet_cache, remote=False
+    )
+else:
+    preview_store = PreviewStore(PREVIEW_DIR, sheet_cache)
+
+# Background jobs.
+if JOBS_BACKEND == "database":
+    with app.app_context():
+        job_store = DatabaseJobStore(db.engine)
+else:
+    job_store = MemoryJobStore()
+jobs = JobQueue(
+    job_store,
+    max_workers=JOB_WORKERS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    context=app.app_context,
+)
+
+
+@jobs.task("upload_sheet_music")
+def upload_sheet_music_job(key):
+    """
+    Sends an uploaded sheet music file from the local cache to s3.
+    """
+    sheet_cache.flush(key)
+
+
+# Whether this process has re-queued the uploads left in the outbox.
+_uploads_resumed = False
+
+
+@app.before_request
+def resume_uploads():
+    """
+    Queues the uploads that an earlier process kept in the sheet music cache
+    but did not send to s3 before it stopped. The memory job store does not
+    survive a restart, so this is done by every process, on its first
+    request.
+    """
+    global _uploads_resumed
+    if _uploads_resumed or not ASYNC_UPLOADS or JOBS_BACKEND == "database":
+        return
+    _uploads_resumed = True
+    for key in sheet_cache.pending():
+        jobs.enqueue("upload_sheet_music", key=key)
+
+
+@jobs.task("generate_preview")
+def generate_preview_job(key):
+    """
+    Renders the preview of an uploaded sheet music file.
+    """
+    preview_store.generate(key)
+
+
+# Postgres keeps its own JSON type; other databases (e.g. an offline SQLite
+# snapshot) get the generic one, which stores JSON as text.
+PortableJSON = JSON().with_variant(postgresql.JSON(), "postgresql")
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 class Song(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(), unique=True, nullable=False)
     copyright = db.Column(db.String(), nullable=True)
-    lyrics = db.Column(JSON, nullable=True)
+    lyrics = db.Column(PortableJSON, nullable=True)
     ccli = db.Column(db.String(), nullable=True)
     default_arrangement = db.Column(db.String(), nullable=True)
     youtube = db.Column(db.String(), nullable=True)
     sheet_music = db.Column(db.String(), nullable=True)
     composer = db.Column(db.String(), nullable=True)
     pinyin = db.Column(db.String(), nullable=True)
+    # Bumped by every UPDATE, which is made conditional on the version that
+    # was loaded, so that concurrent edits cannot silently overwrite each
+    # other (see `save_song`).
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    # Set on every INSERT and UPDATE, for the change feed (see `changes`).
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        index=True,
+        default=utcnow,
+        onupdate=utcnow,
+        server_default=db.func.current_timestamp(),
+    )
+
+    __mapper_args__ = {"version_id_col": version}
+    # Never reuse the id of a deleted song on SQLite; the change feed and
+    # its tombstones assume ids are not reused. (Postgres uses a sequence.)
+    __table_args__ = {"sqlite_autoincrement": True}
 
     def _add_default_arrangement(self, default_arrangement):
         # Firstly, we make sure that every element in default_arrangement is
@@ -50,16 +276,317 @@ class Song(db.Model):
             self.default_arrangement = default_arrangement
 
 
+class SongTombstone(db.Model):
+    """
+    Records that a song was deleted, so that the change feed can tell
+    mirrors to delete it too.
+    """
+
+    __tablename__ = "song_tombstone"
+    id = db.Column(db.Integer, primary_key=True)
+    deleted_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+# Columns needed to render the song listing. Everything else (in particular
+# the `lyrics` JSON blob) is deferred and never loaded on the index page.
+LISTING_COLUMNS = (
+    Song.id,
+    Song.name,
+    Song.pinyin,
+    Song.composer,
+    Song.copyright,
+    Song.default_arrangement,
+    Song.sheet_music,
+    Song.youtube,
+    Song.version,
+)
+
+# Text columns that are converted to traditional characters on save.
+CONVERTED_FIELDS = (
+    "name",
+    "copyright",
+    "ccli",
+    "default_arrangement",
+    "composer",
+)
+
+# Columns added to `song` since it was first created, with their DDL, for
+# `flask upgrade-db`.
+SONG_UPGRADES = {
+    "version": "INTEGER NOT NULL DEFAULT 1",
+    "updated_at": "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+}
+
+
 @app.route("/")
 def view_all():
     """
     Master view for all songs in the database.
 
+    Songs are paginated by keyset over `id`, so the cost of rendering a page
+    does not depend on the size of the catalog. Accepts the query parameters:
+
+    - `limit`: the number of songs per page (defaults to `env.PAGE_SIZE`).
+    - `after`: the id of the last song on the previous page.
+
     :returns: Renders an HTML table of songs.
     """
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    after = request.args.get("after", None, type=int)
+
+    query = Song.query.options(load_only(*LISTING_COLUMNS))
+    all_songs, next_after = keyset_page(query, Song.id, after, limit)
+    return render_template(
+        "songs.html.j2",
+        all_songs=all_songs,
+        limit=limit,
+        after=after,
+        next_after=next_after,
+    )
+
+
+def ensure_song_index():
+    """
+    Builds the in-process search index from the database the first time it
+    is needed. Afterwards it is kept up to date by `save_song`, and every
+    `SEARCH_INDEX_TTL` seconds picks up the songs that other workers saved
+    or deleted (see `refresh_song_index`).
+
+    :returns: The process-wide `SongIndex`.
+    """
+    if not song_index.built:
+        synced_at = utcnow()
+        song_index.build(Song.query.yield_per(500))
+        song_index.synced_at = synced_at
+        song_index.checked_at = time.monotonic()
+    elif time.monotonic() - song_index.checked_at > SEARCH_INDEX_TTL:
+        refresh_song_index()
+    return song_index
+
+
+def refresh_song_index():
+    """
+    Re-indexes the songs saved, and removes the songs deleted, since the
+    index was last brought up to date. Only the changed rows are read, like
+    the change feed does.
+    """
+    # Transactions that commit late can have slightly older timestamps.
+    since = song_index.synced_at - OVERLAP
+    synced_at = utcnow()
+    # Deletions first, so that a song whose id was reused stays indexed.
+    deleted = db.session.scalars(
+        db.select(SongTombstone.id).where(SongTombstone.deleted_at >= since)
+    )
+    for id in deleted:
+        song_index.remove(id)
+    for song in Song.query.filter(Song.updated_at >= since):
+        song_index.update(song)
+    song_index.synced_at = synced_at
+    song_index.checked_at = time.monotonic()
+
+
+def index_song(song):
+    """
+    Keeps whichever search backend is in use up to date with a song. Must be
+    called before the song's changes are committed: the database search
+    table is written in the same transaction, and the in-process index is
+    only updated once the commit has succeeded.
+    """
+    index_songs([song])
+
+
+def index_songs(songs):
+    """
+    Like `index_song`, for many songs at once.
+    """
+    if SEARCH_BACKEND == "database":
+        sync_songs(db.session, songs)
+    elif song_index.built:
+        db.session.info.setdefault("reindex", []).extend(songs)
+
 
-    all_songs = Song.query.all()
-    return render_template("songs.html.j2", all_songs=all_songs)
+@event.listens_for(db.session, "after_commit")
+def reindex_committed(session):
+    for song in session.info.pop("reindex", []):
+        song_index.update(song)
+
+
+@event.listens_for(db.session, "after_rollback")
+def forget_rolled_back(session):
+    session.info.pop("reindex", None)
+
+
+@app.cli.command("init-search")
+def init_search():
+    """
+    Creates and fills the database search table.
+    """
+    create_search_tables(db.session)
+    songs = Song.query.yield_per(500)
+    sync_songs(db.session, songs)
+    db.session.commit()
+
+
+# Makes sure that `song.id` is allocated by a sequence on Postgres.
+POSTGRES_ID_SEQUENCE = (
+    "CREATE SEQUENCE IF NOT EXISTS song_id_seq OWNED BY song.id",
+    "ALTER TABLE song ALTER COLUMN id SET DEFAULT nextval('song_id_seq')",
+    "SELECT setval('song_id_seq', (SELECT coalesce(max(id), 0) + 1 FROM song),"
+    " false)",
+)
+
+
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """
+    Adds the columns (and tables) that are missing from an existing
+    database.
+    """
+    existing = {c["name"] for c in inspect(db.engine).get_columns("song")}
+    for column, ddl in SONG_UPGRADES.items():
+        if column not in existing:
+            db.session.execute(
+                text(f"ALTER TABLE song ADD COLUMN {column} {ddl}")
+            )
+            print(f"Added song.{column}.")
+    db.session.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_song_updated_at "
+            "ON song (updated_at)"
+        )
+    )
+    SongTombstone.__table__.create(db.session.connection(), checkfirst=True)
+    if db.engine.dialect.name == "postgresql":
+        # Ids used to be assigned by the app, so make sure that they come
+        # from a sequence, and that the sequence is past every used id.
+        for statement in POSTGRES_ID_SEQUENCE:
+            db.session.execute(text(statement))
+    db.session.commit()
+
+
+@app.cli.command("fill-pinyin")
+def fill_pinyin():
+    """
+    Fills in the pinyin of every song whose pinyin is missing or stale.
+    """
+    songs = Song.query.options(
+        load_only(Song.id, Song.name, Song.pinyin, Song.version)
+    )
+    updates = [
+        dict(id=song.id, version=song.version, pinyin=romanize(song.name))
+        for song in songs.yield_per(500)
+        if song.pinyin != romanize(song.name)
+    ]
+    if updates:
+        db.session.execute(db.update(Song), updates)
+        if SEARCH_BACKEND == "database":
+            # The search table holds the pinyin too.
+            for ids in chunked((u["id"] for u in updates), 500):
+                changed = Song.query.filter(Song.id.in_(ids))
+                sync_songs(db.session, changed.populate_existing())
+        db.session.commit()
+    print(f"Updated pinyin for {len(updates)} songs.")
+
+
+@app.cli.command("init-jobs")
+def init_jobs():
+    """
+    Creates the `job` table used when `JOBS_BACKEND=database`.
+    """
+    job_store.create()
+
+
+@app.cli.command("run-jobs")
+def run_jobs():
+    """
+    Runs every queued job (e.g. ones left over from a restart), and waits
+    for them to finish.
+    """
+    print(f"Running {jobs.resume()} queued jobs.")
+    jobs.shutdown(wait=True)
+
+
+@app.route("/jobs")
+def list_jobs():
+    """
+    Lists the most recent background jobs, as JSON.
+    """
+    limit = request.args.get("limit", 50, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return jsonify(jobs=jobs.store.recent(limit))
+
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    """
+    Reports the status of a background job, as JSON.
+    """
+    job = jobs.status(job_id)
+    if job is None:
+        return jsonify(error=f"No job {job_id}"), 404
+    return jsonify(job)
+
+
+@app.route("/search")
+def search():
+    """
+    Searches songs by name, pinyin, composer, copyright and lyrics. Accepts
+    the query parameters:
+
+    - `q`: the search query. Simplified characters are converted first.
+    - `limit`: the maximum number of results (defaults to `env.PAGE_SIZE`).
+    - `format`: set to `json` to get JSON rather than HTML.
+
+    Uses the in-process index, or the database if `env.SEARCH_BACKEND` is
+    set to "database".
+
+    :returns: Ranked search results, either as JSON or as the song table.
+    """
+    q = convert(request.args.get("q", ""))
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if SEARCH_BACKEND == "database":
+        results = search_songs(db.session, q, limit=limit)
+    else:
+        results = ensure_song_index().search(q, limit=limit)
+
+    ids = [id for id, _ in results]
+    songs = (
+        Song.query.options(load_only(*LISTING_COLUMNS))
+        .filter(Song.id.in_(ids))
+        .all()
+    )
+    rank = {id: i for i, id in enumerate(ids)}
+    songs = sorted(songs, key=lambda s: rank[s.id])
+
+    wants_json = request.args.get("format") == "json" or (
+        request.accept_mimetypes.best == "application/json"
+    )
+    if wants_json:
+        scores = dict(results)
+        return jsonify(
+            query=q,
+            results=[
+                dict(
+                    id=s.id,
+                    score=scores[s.id],
+                    name=s.name,
+                    pinyin=s.pinyin,
+                    composer=s.composer,
+                    copyright=s.copyright,
+                )
+                for s in songs
+            ],
+        )
+    return render_template(
+        "songs.html.j2",
+        all_songs=songs,
+        q=q,
+        limit=limit,
+        after=None,
+        next_after=None,
+    )
 
 
 @app.route("/<int:id>")
@@ -75,52 +602,470 @@ def view(id):
     return render_template("song.html.j2", song=song)
 
 
+def blank_song(**fields):
+    """
+    Returns the column values of a new song, with every text column filled
+    in, and any `fields` given.
+
+    New songs get a unique placeholder name, because names are unique and
+    several people may be adding songs at the same time.
+
+    :rtype: `dict`
+    """
+    song = dict(
+        name=f"Name {secrets.token_hex(4)}",
+        copyright="",
+        lyrics={"section-1": "section-1", "section-2": "section-2"},
+        ccli="",
+        default_arrangement="",
+        youtube="",
+        sheet_music="",
+        composer="",
+    )
+    song.update(fields)
+    return song
+
+
+def prepare_songs(songs):
+    """
+    Fills in new songs' column values (see `blank_song`), converts their
+    text to traditional characters in one batch, and fills in the pinyin of
+    each name.
+
+    :param songs: An iterable of `dict`s of column values. Ids are ignored.
+    :returns: A list of `dict`s, ready to be inserted.
+    """
+    songs = [blank_song(**song) for song in songs]
+    for song in songs:
+        song.pop("id", None)
+        song.pop("version", None)
+
+    # Convert every text field and lyrics section of every song together.
+    texts = []
+    for song in songs:
+        texts.extend(song[f] or "" for f in CONVERTED_FIELDS)
+        texts.extend(song["lyrics"].values())
+    converted = iter(converter.convert_many(texts))
+    for song in songs:
+        for f in CONVERTED_FIELDS:
+            song[f] = next(converted)
+        song["lyrics"] = {s: next(converted) for s in song["lyrics"]}
+        song["pinyin"] = romanize(song["name"])
+    return songs
+
+
+def create_songs(songs, prepared=False):
+    """
+    Inserts new songs in a single INSERT ... RETURNING statement. Their ids
+    are allocated by the database, so concurrent workers never collide.
+    Does not commit.
+
+    :param songs: An iterable of `dict`s of column values (see
+        `blank_song`). Ids are ignored.
+    :param prepared: Whether `songs` were already passed through
+        `prepare_songs`.
+    :returns: The new `Song` objects, in the same order.
+    """
+    if not prepared:
+        songs = prepare_songs(songs)
+    if not songs:
+        return []
+    created = db.session.scalars(
+        db.insert(Song).returning(Song, sort_by_parameter_order=True), songs
+    ).all()
+    index_songs(created)
+    return created
+
+
+def import_songs(records, batch_size=500):
+    """
+    Imports songs in chunks. Each chunk is validated, converted in one
+    batch, inserted in one statement and committed, so that a bad record
+    only loses itself, and a failure only loses its own chunk.
+
+    Songs whose name is already taken are rejected.
+
+    :param records: An iterable of `(ref, record)` tuples, as returned by
+        `importer.read_records`.
+    :returns: An `importer.ImportReport`.
+    """
+    report = ImportReport()
+    for chunk in chunked(records, batch_size):
+        valid = []
+        for ref, record in chunk:
+            try:
+                valid.append((ref, validate_record(record)))
+            except ValueError as e:
+                report.error(ref, e)
+        songs = prepare_songs(song for _, song in valid)
+
+        names = [song["name"] for song in songs]
+        taken = set(
+            db.session.scalars(
+                db.select(Song.name).where(Song.name.in_(names))
+            )
+        )
+        batch = []
+        for (ref, _), song in zip(valid, songs):
+            if song["name"] in taken:
+                report.error(ref, f"A song named {song['name']} exists")
+                continue
+            taken.add(song["name"])
+            batch.append((ref, song))
+
+        try:
+            create_songs([song for _, song in batch], prepared=True)
+            db.session.commit()
+        except IntegrityError as e:
+            # E.g. someone else added one of the names in the meantime.
+            db.session.rollback()
+            for ref, _ in batch:
+                report.error(ref, f"Chunk not imported: {e.orig}")
+            continue
+        report.imported += len(batch)
+        log.info(f"Imported {report.imported} songs.")
+    return report
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of up to `size` items of `iterable`.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@app.cli.command("import-songs")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format", "fmt", type=click.Choice(FORMATS), help="Default: from PATH."
+)
+@click.option("--batch-size", default=500, help="Songs per transaction.")
+def import_songs_command(path, fmt, batch_size):
+    """
+    Imports the songs in PATH (YAML, JSONL or text, see `app.importer`).
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        records = read_records(f, fmt or guess_format(path))
+        print(import_songs(records, batch_size=batch_size))
+
+
+@app.route("/import", methods=["POST"])
+def import_songs_view():
+    """
+    Imports the songs in an uploaded file (`file`). The format is taken from
+    the `format` form field, or else the file's extension.
+
+    :returns: The import report, as JSON.
+    """
+    f = request.files["file"]
+    fmt = request.form.get("format") or guess_format(f.filename or "")
+    if fmt not in FORMATS:
+        return jsonify(error=f"Unknown format {fmt!r}"), 400
+    report = import_songs(read_records(f.stream, fmt))
+    return jsonify(report.to_dict())
+
+
 @app.route("/add")
 def new():
     """
     Sends us to a blank song.
     """
-    song = Song()
-    song.id = len(Song.query.all())
-    song.name = "Name"
-    song.copyright = ""
-    song.lyrics = {"section-1": "section-1", "section-2": "section-2"}
-    song.ccli = ""
-    song.default_arrangement = ""
-    song.youtube = ""
-    song.sheet_music = ""
-    song.pdf_preview = ""
-    song.composer = ""
-    song.pinyin = ""
-    db.session.add(song)
+    (song,) = create_songs([dict()])
     db.session.commit()
     return redirect(f"/{song.id}")
 
 
+@app.route("/songs", methods=["POST"])
+def create_songs_view():
+    """
+    Creates many songs at once. Accepts JSON, either:
+
+    - `{"count": 10}` to create blank songs (at most `MAX_PAGE_SIZE`), or
+    - `{"songs": [{"name": ..., "lyrics": {...}, ...}, ...]}` to create
+      prefilled ones. Missing fields are left blank. Songs are checked like
+      imported ones (see `importer.validate_record`), and if any is invalid,
+      none are created.
+
+    :returns: The ids of the new songs, as JSON, or the errors with status
+        400.
+    """
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="Expected a JSON object"), 400
+    if "songs" in data:
+        if not isinstance(data["songs"], list):
+            return jsonify(error="songs must be a list"), 400
+        songs, errors = [], []
+        for i, record in enumerate(data["songs"], 1):
+            if isinstance(record, dict) and "name" not in record:
+                record = dict(record, name=blank_song()["name"])
+            try:
+                song = validate_record(record)
+            except ValueError as e:
+                errors.append(dict(ref=f"song {i}", error=str(e)))
+                continue
+            if "lyrics" not in record:
+                # Leave the blank song's placeholder sections.
+                del song["lyrics"]
+            songs.append(song)
+        if errors:
+            return jsonify(errors=errors), 400
+    else:
+        try:
+            count = int(data.get("count", 1))
+        except (TypeError, ValueError):
+            return jsonify(error="count must be a number"), 400
+        count = max(1, min(count, MAX_PAGE_SIZE))
+        songs = [dict() for _ in range(count)]
+    try:
+        created = create_songs(songs)
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        return jsonify(error=str(e.orig)), 409
+    return jsonify(ids=[song.id for song in created]), 201
+
+
 from .utils import validate_song
 
 
-def save_song(id, request):
+class SongConflict(Exception):
+    """
+    Raised when a song was changed by someone else since it was loaded.
+
+    :attr song: The song as it is now stored.
+    """
+
+    def __init__(self, song):
+        super().__init__(f"Song {song.id} was changed by someone else.")
+        self.song = song
+
+
+@app.errorhandler(SongConflict)
+def song_conflict(e):
+    """
+    Answers a conflicting save with 409 Conflict and the song as it is now
+    stored: as JSON if asked for, otherwise as the song's page, so that the
+    edits can be made again on top of the other ones.
+    """
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(error=str(e), song=song_dict(e.song)), 409
+    html = render_template("song.html.j2", song=e.song, conflict=True)
+    return html, 409
+
+
+def save_song(id, request, edit=None, **changes):
     """
     Refactored out of `save()` to support both saving and updating.
 
+    This is the unit of work for editing a song: the row is loaded once, the
+    form, `changes` and `edit` are applied to it in memory, and everything is
+    written in a single commit.
+
+    The form is diffed against the stored song: only fields that differ are
+    converted and written, and if nothing changed at all, nothing is written
+    (and the slides stay cached).
+
+    If the form has a `version` and would change the song, the save only
+    succeeds if the song is still at that version: the UPDATE is conditional
+    on it, so that two people editing the same song cannot overwrite each
+    other's changes. A form that matches the stored song is never a
+    conflict, e.g. when the user goes back to a page they already saved.
+
     We do not save the song sheet, because it should already be saved after
     uploading the sheet music to s3.
+
+    :param edit: An optional function that is called with the song after the
+        form has been applied, to make further changes (e.g. adding a lyrics
+        section).
+    :param changes: Extra column values to set on the song, which are
+        committed in the same transaction as the form.
+    :returns: The saved `Song`.
+    :raises SongConflict: If the song is no longer at the form's version.
     """
-    song = Song.query.get(id)
-    song.name = convert(request.form.get("name", ""))
-    song.copyright = convert(request.form.get("copyright", ""))
-    song.lyrics = get_lyrics(request).to_dict()
-    song.ccli = convert(request.form.get("ccli", ""))
-    song.default_arrangement = convert(
-        request.form.get("default_arrangement", "")
-    )
-    song.youtube = request.form.get("youtube", "")
-    song.composer = convert(request.form.get("composer", ""))
-    song.pinyin = pinyin.get(song.name, format="strip", delimiter=" ")
+    song = db.session.get(Song, id)
+    version = request.form.get("version", None, type=int)
+    apply_form(song, request)
+    for attr, value in changes.items():
+        setattr(song, attr, value)
+    if edit is not None:
+        edit(song)
     song = validate_song(song)
 
+    if not db.session.is_modified(song):
+        return song
+    if version is not None and version != song.version:
+        db.session.rollback()
+        raise SongConflict(db.session.get(Song, id, populate_existing=True))
+    try:
+        index_song(song)
+        db.session.commit()
+    except StaleDataError:
+        # Another worker saved the song between our SELECT and UPDATE.
+        db.session.rollback()
+        raise SongConflict(db.session.get(Song, id, populate_existing=True))
+    slides_cache.bump(id)
+    return song
+
+
+def apply_form(song, request):
+    """
+    Applies the song form to a song, converting only the fields that differ
+    from what the song already has.
+    """
+
+    def set_text(attr, value, converted=False):
+        # Text that is the same as stored has already been converted.
+        if value != getattr(song, attr):
+            setattr(song, attr, value if converted else convert(value))
+
+    name = song.name
+    set_text("name", request.form.get("name", ""))
+    # Only re-romanize when the name has actually changed.
+    if song.name != name or not song.pinyin:
+        song.pinyin = romanize(song.name)
+    set_text("copyright", request.form.get("copyright", ""))
+    set_text("ccli", request.form.get("ccli", ""))
+    set_text(
+        "default_arrangement", request.form.get("default_arrangement", "")
+    )
+    set_text("youtube", request.form.get("youtube", ""), converted=True)
+    set_text("composer", request.form.get("composer", ""))
+
+    lyrics = get_lyrics(request, stored=song.lyrics).to_dict()
+    # Compare in order, since the order of the sections is significant.
+    if list(lyrics.items()) != list((song.lyrics or dict()).items()):
+        song.lyrics = lyrics
+
+
+def preview_song(id, request):
+    """
+    Applies the song form to a copy of a song, without saving anything. The
+    song page's slides and export buttons show the form this way: saving
+    there would move the song to a new version behind the page's back, so
+    that saving the page afterwards would be taken for a conflict.
+
+    :returns: A transient `Song`.
+    """
+    song = db.session.get(Song, id)
+    columns = inspect(Song).column_attrs.keys()
+    copy = Song(**{c: getattr(song, c) for c in columns})
+    apply_form(copy, request)
+    return validate_song(copy)
+
+
+@app.route("/<int:id>/delete", methods=["POST"])
+def delete(id):
+    """
+    Deletes a song, and leaves a tombstone for the change feed.
+    """
+    song = db.session.get(Song, id)
+    if song is None:
+        return redirect("/")
+    db.session.delete(song)
+    # An id can be deleted again if it was reused (e.g. on an old SQLite
+    # database), so replace any earlier tombstone.
+    db.session.merge(SongTombstone(id=id, deleted_at=utcnow()))
+    if SEARCH_BACKEND == "database":
+        unsync_songs(db.session, [id])
     db.session.commit()
+    song_index.remove(id)
+    slides_cache.bump(id)
+    return redirect("/")
+
+
+def parse_cursor(cursor):
+    """
+    Parses a change feed cursor, `"<ISO timestamp>,<song id>"`. A bare
+    timestamp is also accepted.
+
+    :returns: `(timestamp, id)`, or `(None, 0)` for an empty cursor.
+    :raises ValueError: If the cursor is malformed.
+    """
+    if not cursor:
+        return None, 0
+    timestamp, _, id = cursor.partition(",")
+    return datetime.fromisoformat(timestamp), int(id or 0)
+
+
+def format_cursor(timestamp, id=0):
+    return f"{timestamp.isoformat()},{id}"
+
+
+@app.route("/changes")
+def changes():
+    """
+    Lists the songs changed and deleted since a point in time, oldest first,
+    so that a mirror only fetches what changed. Accepts the query
+    parameters:
+
+    - `since`: the `next` cursor of the previous page; leave it out to get
+      every song.
+    - `limit`: the maximum number of songs per page.
+
+    :returns: JSON with `songs` (changed songs, in full), `deleted` (ids of
+        deleted songs), `next` (the cursor to continue from) and `more`
+        (whether to ask again right away).
+    """
+    try:
+        since, after = parse_cursor(request.args.get("since"))
+    except ValueError:
+        return jsonify(error="Invalid cursor"), 400
+    limit = request.args.get("limit", MAX_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    query = Song.query.order_by(Song.updated_at, Song.id)
+    if since is not None:
+        query = query.filter(
+            db.tuple_(Song.updated_at, Song.id) > db.tuple_(since, after)
+        )
+    songs = query.limit(limit + 1).all()
+    more = len(songs) > limit
+    songs = songs[:limit]
+
+    tombstones = SongTombstone.query.order_by(SongTombstone.deleted_at)
+    if since is not None:
+        tombstones = tombstones.filter(SongTombstone.deleted_at > since)
+    if more:
+        # Deletions after this page are sent with the next one.
+        end = songs[-1].updated_at
+        tombstones = tombstones.filter(SongTombstone.deleted_at <= end)
+    tombstones = tombstones.all()
+
+    cursor = (since, after) if since is not None else None
+    if songs:
+        cursor = (songs[-1].updated_at, songs[-1].id)
+    if tombstones:
+        deleted_at = tombstones[-1].deleted_at
+        if cursor is None or deleted_at > cursor[0]:
+            cursor = (deleted_at, 0)
+    return jsonify(
+        songs=[
+            dict(song_dict(song), updated_at=song.updated_at.isoformat())
+            for song in songs
+        ],
+        deleted=[t.id for t in tombstones],
+        next=format_cursor(*cursor) if cursor else None,
+        more=more,
+    )
+
+
+@app.cli.command("mirror-sync")
+@click.argument("url")
+@click.argument("path", default="mirror.sqlite")
+def mirror_sync(url, path):
+    """
+    Updates the SQLite mirror at PATH with the changes on the server at URL.
+    """
+    engine = db.create_engine(f"sqlite:///{path}")
+    mirror = Mirror(engine, Song.__table__, http_fetch(url))
+    changed, deleted = mirror.sync()
+    print(f"{changed} songs changed, {deleted} deleted.")
 
 
 @app.route("/<int:id>/save", methods=["POST"])
@@ -148,31 +1093,216 @@ def update(id):
 def slides(id):
     """
     Render slides using revealjs.
+
+    Rendered slides are cached until the song is saved again, and served with
+    an ETag, so that unchanged slides are answered with 304 Not Modified
+    without touching the database.
+
+    A POST shows the slides of the posted song form, without saving it.
     """
     if request.method == "POST":
-        save_song(id, request)
-    song = Song.query.get(id)
-    song = clean_lyrics(song)
-    arrangement = clean_arrangement(song.default_arrangement)
+        return render_slides(preview_song(id, request))
+
+    entry = slides_cache.get(id)
+    if entry is None:
+        version = slides_cache.version(id)
+        body = render_slides(db.session.get(Song, id))
+        entry = slides_cache.put(id, body, version)
+
+    response = make_response(entry.body)
+    response.set_etag(entry.etag)
+    return response.make_conditional(request)
+
+
+def render_slides(song):
+    lyrics = clean_lyrics(song)
+    # Leave out sections that the song does not have, as setlists do.
+    arrangement = [
+        a for a in clean_arrangement(song.default_arrangement) if a in lyrics
+    ]
     return render_template(
-        "slides_single_song.html.j2", song=song, arrangement=arrangement, id=id
+        "slides_single_song.html.j2",
+        song=song,
+        lyrics=lyrics,
+        arrangement=arrangement,
+        id=song.id,
+    )
+
+
+@app.route("/stats/cache")
+def cache_stats():
+    """
+    Reports this worker's cache counters, for monitoring.
+    """
+    return jsonify(
+        slides=slides_cache.info(), sheet_music=sheet_cache.info()
+    )
+
+
+def load_setlist(ids, arrangements=None):
+    """
+    Loads the songs of a setlist in one query, and pairs each with its
+    arrangement.
+
+    :param ids: The song ids, in the order they are sung.
+    :type ids: `list(int)`
+    :param arrangements: One arrangement (a list of section names) per song.
+        Songs without one, or with `None`, use their default arrangement.
+    :returns: A list of `(song, arrangement)` tuples, where `song` is a
+        `dict` as returned by `utils.slide_data`. Unknown ids are skipped, as
+        are sections that the song does not have.
+    """
+    arrangements = arrangements or []
+    songs = {s.id: s for s in Song.query.filter(Song.id.in_(ids))}
+    setlist = []
+    for i, id in enumerate(ids):
+        song = songs.get(id)
+        if song is None:
+            log.warning(f"Song {id} not found; leaving it out of the setlist.")
+            continue
+        data = slide_data(song)
+        arrangement = arrangements[i] if i < len(arrangements) else None
+        if arrangement is None:
+            arrangement = clean_arrangement(song.default_arrangement or "")
+        arrangement = [a for a in arrangement if a in data["lyrics"]]
+        setlist.append((data, arrangement))
+    return setlist
+
+
+@app.route("/slides")
+def setlist_slides():
+    """
+    Renders the slides for a whole setlist as a single deck. Accepts the
+    query parameters:
+
+    - `ids`: comma-delimited song ids, in order, e.g. `3,17,42`.
+    - `arr`: optional arrangements, see `utils.parse_arrangements`.
+
+    All songs are loaded in one query.
+    """
+    try:
+        ids = parse_ids(request.args.get("ids", ""))
+    except ValueError:
+        return "ids must be comma-delimited song ids.", 400
+    setlist = load_setlist(ids, parse_arrangements(request.args.get("arr")))
+    return render_template("slides_multi_song.html.j2", songs=setlist)
+
+
+@app.route("/slides/bundle")
+def slides_bundle():
+    """
+    Downloads a zip file of self-contained slides for offline projection.
+    Accepts the query parameters:
+
+    - `ids`: comma-delimited song ids, in order.
+    - `arr`: optional arrangements, see `utils.parse_arrangements`.
+    """
+    try:
+        ids = parse_ids(request.args.get("ids", ""))
+    except ValueError:
+        return "ids must be comma-delimited song ids.", 400
+    setlist = load_setlist(ids, parse_arrangements(request.args.get("arr")))
+    buf = BytesIO()
+    write_bundle(render_bundle(app.jinja_env, setlist), buf)
+    buf.seek(0)
+    return send_file(
+        buf,
+        mimetype="application/zip",
+        as_attachment=True,
+        download_name="slides.zip",
     )
 
 
+@app.cli.command("export-slides")
+@click.argument("ids")
+@click.option("--arr", default="", help="Arrangements, e.g. 'V,C;A,B'.")
+@click.option(
+    "--out", default="slides.zip", help="A directory, or a .zip file."
+)
+def export_slides(ids, arr, out):
+    """
+    Renders self-contained slides for the songs IDS (e.g. 3,17,42).
+    """
+    try:
+        ids = parse_ids(ids)
+    except ValueError:
+        raise click.BadParameter(
+            "must be comma-delimited song ids.", param_hint="IDS"
+        )
+    setlist = load_setlist(ids, parse_arrangements(arr))
+    write_bundle(render_bundle(app.jinja_env, setlist), out)
+    print(f"Wrote slides for {len(setlist)} songs to {out}.")
+
+
+def all_songs(batch_size=500):
+    """
+    Yields every song in id order, fetched `batch_size` rows at a time from
+    a server-side cursor, so that memory use does not grow with the library.
+    """
+    return Song.query.order_by(Song.id).yield_per(batch_size)
+
+
+@app.route("/export")
+def export_library():
+    """
+    Downloads every song. Accepts the query parameters:
+
+    - `format`: "jsonl" (the default), "yaml" or "text"; see `app.exporter`.
+    - `gzip`: set to 1 to compress the download.
+
+    The response is streamed while the songs are read, so that exporting
+    the whole library uses constant memory.
+    """
+    fmt = request.args.get("format", "jsonl")
+    if fmt not in CONTENT_TYPES:
+        return jsonify(error=f"Unknown format {fmt!r}"), 400
+    body = export_records(all_songs(), fmt)
+    filename = f"songs.{EXTENSIONS[fmt]}"
+    mimetype = CONTENT_TYPES[fmt]
+    if request.args.get("gzip") == "1":
+        body = gzip_chunks(body)
+        filename += ".gz"
+        mimetype = "application/gzip"
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers["Content-Disposition"] = content_disposition(filename)
+    return response
+
+
+@app.cli.command("export-songs")
+@click.argument("out", type=click.File("wb"))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(list(CONTENT_TYPES)),
+    help="Default: from OUT's extension, else jsonl.",
+)
+def export_songs_command(out, fmt):
+    """
+    Writes every song to OUT (a file, or - for stdout). OUT is compressed if
+    it ends in .gz.
+    """
+    body = export_records(all_songs(), fmt or format_for(out.name))
+    if out.name.endswith(".gz"):
+        chunks = gzip_chunks(body)
+    else:
+        chunks = (chunk.encode("utf-8") for chunk in body)
+    for chunk in chunks:
+        out.write(chunk)
+
+
 @app.route("/<int:id>/add_lyrics_section", methods=["POST"])
 def add_lyrics_section(id):
-    # Update song
-    save_song(id, request)
-    song = Song.query.get(id)
-    count = len(song.lyrics) + 1
-    song.lyrics.update({f"section-{count}": f"section-{count}"})
-    flag_modified(song, "lyrics")
+    """
+    Saves the song and adds a blank lyrics section to it, in one commit.
+    """
 
-    # Commit to database
-    db.session.merge(song)
-    db.session.commit()
+    def add_section(song):
+        count = len(song.lyrics) + 1
+        song.lyrics = dict(
+            song.lyrics, **{f"section-{count}": f"section-{count}"}
+        )
 
-    # Redirect
+    save_song(id, request, edit=add_section)
     return redirect(f"/{id}")
 
 
@@ -180,17 +1310,16 @@ def add_lyrics_section(id):
     "/<int:id>/remove_lyrics_section/<int:section_id>", methods=["POST"]
 )
 def remove_lyrics_section(id, section_id):
-    # Update song
-    save_song(id, request)
-    song = Song.query.get(id)
-    del song.lyrics[f"section-{section_id}"]
-    flag_modified(song, "lyrics")
+    """
+    Saves the song and removes a blank lyrics section from it, in one commit.
+    """
 
-    # Commit to database
-    db.session.merge(song)
-    db.session.commit()
+    def remove_section(song):
+        lyrics = dict(song.lyrics)
+        del lyrics[f"section-{section_id}"]
+        song.lyrics = lyrics
 
-    # Redirect
+    save_song(id, request, edit=remove_section)
     return redirect(f"/{id}")
 
 
@@ -198,13 +1327,14 @@ def remove_lyrics_section(id, section_id):
 @app.route("/<int:id>/export", methods=["POST"])
 def export_lyrics(id):
     """
-    View function for lyrics export.
+    View function for lyrics export. A POST exports the posted song form,
+    without saving it.
     """
     if request.method == "POST":
-        save_song(id, request)
-    song = Song.query.get(id)
-    song = clean_lyrics(song)
-    output = lyrics_plaintext(song)
+        song = preview_song(id, request)
+    else:
+        song = db.session.get(Song, id)
+    output = lyrics_plaintext(song, clean_lyrics(song))
     return render_template("song_export.html.j2", output=output)
 
 
@@ -233,91 +1363,291 @@ def upload_sheet_music(id):
         return redirect(f"/songs/{id}")
 
     if f and allowed_file(f.filename):
-        # Compute the song filename.
-        fname = f"{str(uuid.uuid4())}.pdf"
-        # Save the file to disk temporarily.
-        log.debug("Saving to disk temporarily")
-        fpath = str(f"/tmp/{fname}")
-        f.save(fpath)
-
-        log.debug("Uploading to s3")
-        # Save the file to S3
-        s3ul(fpath, fname)
-        # Update the song database
+        # Files are stored under the hash of their contents, so re-uploading
+        # a file that is already on s3 does not store or send it again.
+        if ASYNC_UPLOADS:
+            # Keep the file in the local cache, and send it to s3 later.
+            fname = sheet_cache.add_file(f.stream)
+            jobs.enqueue("upload_sheet_music", key=fname)
+        else:
+            log.debug("Streaming to s3")
+            fname = s3ul_dedup(f.stream)
+        log.debug(f"Stored sheet music as {fname}.")
+        if previews_available():
+            jobs.enqueue("generate_preview", key=fname)
+
+        # Update the song database, form and sheet music in one transaction.
         log.debug("Updating song database.")
-        song = Song.query.get(id)
-        save_song(id, request)
-        song.sheet_music = fname
-        flag_modified(song, "sheet_music")
-        db.session.merge(song)
-        db.session.commit()
+        save_song(id, request, sheet_music=fname)
 
         return redirect(f"/{id}")
 
 
-@app.route("/<int:id>/sheet_music/download")
-def download_sheet_music(id):
-    """
-    Returns the sheet music to be downloaded.
+# The keys this app writes to the bucket: sheet music named after its hash
+# (or, for older uploads, a uuid), its previews, and streamed uploads in
+# flight. `gc-sheet-music` leaves anything else alone.
+_NAME = r"(?:[0-9a-f]{64}|[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})"
+GC_KEY = re.compile(
+    rf"^(?:(?:uploads/)?{_NAME}\.pdf|previews/{_NAME}\.jpg)$"
+)
 
-    :param id: The id of the song.
-    :type id: int
 
-    :returns: The song sheet PDF.
+def sheet_music_refcounts():
     """
-    song = Song.query.get(id)
-    fname = song.sheet_music
-    # Use s3dl utility function to conditionally download file.
-    s3dl(fname)
+    Counts how many songs refer to each sheet music file. Identical uploads
+    share one file, so a file can be referred to by several songs.
 
-    # Change the name of the file so that it is easier to read.
-    new_fname = f"{song.name}-{song.composer}-{song.copyright}.pdf"
-    os.system(f"cp /tmp/{fname} /tmp/{new_fname}")
-
-    # Return the file.
-    return send_file(f"/tmp/{new_fname}", as_attachment=True)
+    :returns: A `dict` of s3 key to number of songs.
+    """
+    query = (
+        db.session.query(Song.sheet_music, func.count())
+        .filter(Song.sheet_music.isnot(None), Song.sheet_music != "")
+        .group_by(Song.sheet_music)
+    )
+    return dict(query.all())
 
 
-# Below are a bunch of s3-specific utility functions. I may refactor them
-# out at a later date.
+@app.cli.command("gc-sheet-music")
+@click.option("--dry-run", is_flag=True, help="Only report what to delete.")
+@click.option(
+    "--grace",
+    default=3600,
+    help="Keep files younger than this many seconds (uploads in flight).",
+)
+def gc_sheet_music(dry_run, grace):
+    """
+    Deletes sheet music files (and their previews) on s3 that no song refers
+    to.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    objects = [obj for obj in s3list() if GC_KEY.match(obj["Key"])]
+    refcounts = sheet_music_refcounts()
+    in_use = set(refcounts) | {preview_key(key) for key in refcounts}
+    garbage = [
+        obj["Key"]
+        for obj in objects
+        if obj["Key"] not in in_use and obj["LastModified"] < cutoff
+    ]
+    shared = sum(1 for n in refcounts.values() if n > 1)
+    print(
+        f"{len(objects)} files, {len(refcounts)} in use "
+        f"({shared} shared by several songs), {len(garbage)} unreferenced."
+    )
+    if dry_run:
+        return
+    # Songs saved while the bucket was being listed may refer to some of
+    # these by now.
+    refcounts = sheet_music_refcounts()
+    in_use = set(refcounts) | {preview_key(key) for key in refcounts}
+    garbage = [key for key in garbage if key not in in_use]
+    deleted = s3del_many(garbage)
+    for key in garbage:
+        sheet_cache.discard(key)
+    print(f"Deleted {deleted} files.")
+
+
+@app.cli.command("generate-previews")
+@click.option("--all", "redo", is_flag=True, help="Re-render every preview.")
+@click.option(
+    "--workers", default=PREVIEW_WORKERS, help="Rendering processes."
+)
+def generate_previews(redo, workers):
+    """
+    Renders the previews of sheet music that does not have one yet.
+    """
+    keys = list(sheet_music_refcounts())
+    if not redo:
+        existing = {obj["Key"] for obj in s3list()}
+        keys = [key for key in keys if preview_key(key) not in existing]
+    rendered = preview_store.generate_many(keys, max_workers=workers)
+    print(f"Rendered {rendered} of {len(keys)} previews.")
 
 
-def s3bucket():
-    s3 = boto3.resource("s3")
-    bucket = os.environ["S3_BUCKET_NAME"]
-    return s3.Bucket(bucket)
+@app.route("/previews/<key>")
+def sheet_music_preview(key):
+    """
+    Returns the first-page preview (a JPEG) of a sheet music file.
 
+    Previews of files stored under the hash of their contents never change,
+    so they are cached by browsers for a year. Older files may be replaced
+    under the same name, so their previews are revalidated daily. A missing
+    preview may be rendered soon, so the 404 is only cached briefly.
 
-def s3dl(fname):
+    :param key: The s3 key of the sheet music file.
     """
-    Downloads a file from S3. Does this conditionally; if the file already
-    exists, then we do not download it.
+    try:
+        path = preview_store.get(key)
+    except ValueError:
+        path = None
+    if path is None:
+        response = Response(status=404)
+        response.cache_control.public = True
+        response.cache_control.max_age = preview_store.miss_ttl
+        return response
+    immutable = is_content_key(key)
+    response = send_file(
+        path,
+        mimetype="image/jpeg",
+        conditional=True,
+        max_age=31536000 if immutable else 86400,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = immutable
+    return response
 
-    Does not return anything
+
+@app.route("/<int:id>/sheet_music/download")
+def download_sheet_music(id):
     """
-    pathstr = f"/tmp/{fname}"
-    if not Path(pathstr).exists():
-        s3bucket().download_file(fname, f"/tmp/{fname}")
+    Returns the sheet music to be downloaded.
 
+    If `env.SHEET_MUSIC_DELIVERY` is "presigned", redirects to a short-lived
+    presigned s3 URL, so that the bytes never pass through this worker.
 
-def s3ul(fpath, fname):
-    """
-    Uploads a file to S3.
-    """
-    s3bucket().upload_file(fpath, fname, ExtraArgs={"ACL": "public-read"})
+    Otherwise, cached files are sent from disk, and other files are streamed
+    straight from s3 (and into the cache on the way), so the download starts
+    right away. Both support HTTP Range and conditional requests.
 
+    :param id: The id of the song.
+    :type id: int
 
-def s3del(fname):
+    :returns: The song sheet PDF.
     """
-    Deletes a file from s3.
+    song = Song.query.get(id)
+    # Serve the file under a name that is easier to read.
+    new_fname = f"{song.name}-{song.composer}-{song.copyright}.pdf"
+
+    if OFFLINE:
+        path = local_sheet_music(song.sheet_music)
+        if path is None:
+            return Response(status=404)
+        return send_file(
+            path,
+            mimetype="application/pdf",
+            as_attachment=True,
+            download_name=new_fname,
+            conditional=True,
+        )
+
+    if SHEET_MUSIC_DELIVERY == "presigned":
+        return redirect(presigned_urls.get(song.sheet_music, new_fname))
+
+    path = sheet_cache.lookup(song.sheet_music)
+    if path is not None:
+        return send_file(
+            path,
+            mimetype="application/pdf",
+            as_attachment=True,
+            download_name=new_fname,
+            conditional=True,
+        )
+    return stream_sheet_music(song.sheet_music, new_fname)
+
+
+def local_sheet_music(key):
     """
-    s3bucket().delete_objects(Delete={"Objects": [{"Key": fname}]})
+    :returns: The path of a sheet music file in `env.SHEET_MUSIC_DIR` (see
+        `flask snapshot`), or `None` if it is not there.
+    """
+    if not key or "/" in key or key.startswith("."):
+        return None
+    path = Path(SHEET_MUSIC_DIR) / key
+    return path if path.is_file() else None
+
+
+@app.cli.command("snapshot")
+@click.argument("path", default="snapshot.sqlite")
+@click.option(
+    "--sheet-music",
+    default=SHEET_MUSIC_DIR,
+    help="Where to put the sheet music and its previews.",
+)
+@click.option("--no-sheet-music", is_flag=True, help="Only copy the songs.")
+def snapshot(path, sheet_music, no_sheet_music):
+    """
+    Copies every song into the SQLite database PATH, and the sheet music
+    into a directory, for running the app offline (see `env.OFFLINE`).
+    Afterwards, `flask mirror-sync URL PATH` brings it up to date.
+    """
+    engine = db.create_engine(f"sqlite:///{path}")
+    mirror = Mirror(engine, Song.__table__, fetch=None)
+    mirror.create()
+    table = Song.__table__
+    rows = db.session.execute(
+        db.select(table).order_by(table.c.updated_at, table.c.id),
+        execution_options=dict(yield_per=500),
+    )
+    copied = 0
+    last = None
+    with engine.begin() as conn:
+        conn.execute(table.delete())
+        for chunk in chunked(rows, 500):
+            conn.execute(table.insert(), [row._asdict() for row in chunk])
+            copied += len(chunk)
+            last = chunk[-1]
+        if last is not None:
+            mirror.set_cursor(conn, format_cursor(last.updated_at, last.id))
+    print(f"Copied {copied} songs to {path}.")
+
+    if no_sheet_music:
+        return
+    keys = list(sheet_music_refcounts())
+    fetched = s3download_many(keys, sheet_music)
+    fetched_previews = s3download_many(
+        [preview_key(key) for key in keys], sheet_music
+    )
+    print(
+        f"Downloaded {fetched} sheet music files and {fetched_previews} "
+        f"previews to {sheet_music}."
+    )
 
 
-def s3rename(old, new):
+def stream_sheet_music(key, download_name):
     """
-    Renames a file on s3.
+    Streams a file from s3 to the client in chunks, passing the request's
+    Range and conditional headers on to s3.
+
+    :param key: The s3 key of the file.
+    :param download_name: The name to save the file as.
+    :returns: A streaming `Response`.
     """
-    s3dl(old)
-    s3ul(f"/tmp/{old}", new)
-    s3del(old)
+    params = dict(Bucket=bucket, Key=key)
+    if request.range is not None:
+        params["Range"] = request.headers["Range"]
+    if request.if_none_match:
+        params["IfNoneMatch"] = request.headers["If-None-Match"]
+    if request.if_modified_since is not None:
+        params["IfModifiedSince"] = request.if_modified_since
+
+    try:
+        obj = s3client().get_object(**params)
+    except ClientError as e:
+        status = e.response["ResponseMetadata"]["HTTPStatusCode"]
+        if status in (304, 404, 412, 416):
+            return Response(status=status)
+        raise
+
+    if "ContentRange" in obj:
+        status = 206
+        body = obj["Body"].iter_chunks(CHUNK_SIZE)
+    else:
+        status = 200
+        body = sheet_cache.stream(key, obj)
+
+    response = Response(
+        body,
+        status=status,
+        mimetype="application/pdf",
+        direct_passthrough=True,
+    )
+    headers = response.headers
+    headers["Content-Length"] = obj["ContentLength"]
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Disposition"] = content_disposition(download_name)
+    if "ContentRange" in obj:
+        headers["Content-Range"] = obj["ContentRange"]
+    if obj.get("ETag"):
+        headers["ETag"] = obj["ETag"]
+    if obj.get("LastModified"):
+        response.last_modified = obj["LastModified"]
+    return response
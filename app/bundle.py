@@ -0,0 +1,123 @@
+"""
+Self-contained slide bundles for offline projection.
+
+A bundle is a directory (or zip file) of HTML pages with the reveal.js CSS
+and JavaScript inlined, so that the projection machine can show the slides
+straight from disk without any network access.
+"""
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+REVEALJS = Path(__file__).parent / "static" / "revealjs"
+CSS_FILES = ["css/reveal.css", "css/theme/night.css"]
+JS_FILES = ["js/reveal.js"]
+
+BUNDLE_TEMPLATE = "slides_offline.html.j2"
+
+
+def minify_css(css):
+    """
+    Removes comments, remote `@import`s (e.g. web fonts, which are not
+    available offline) and redundant whitespace from CSS.
+    """
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"@import\s+url\([^)]*\)\s*;", "", css)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    return css.strip()
+
+
+def minify_js(js):
+    """
+    Conservatively shrinks JavaScript: drops indentation, blank lines and
+    lines that are entirely comments. Code inside lines is left untouched.
+    """
+    lines = []
+    in_comment = False
+    for line in js.splitlines():
+        line = line.strip()
+        if in_comment:
+            in_comment = "*/" not in line
+            continue
+        if not line or line.startswith("//"):
+            continue
+        if line.startswith("/*"):
+            in_comment = "*/" not in line
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=1)
+def load_assets():
+    """
+    Reads and minifies the reveal.js assets once.
+
+    :returns: `(css, js)`, as strings.
+    """
+    css = "\n".join(
+        minify_css((REVEALJS / f).read_text(encoding="utf-8"))
+        for f in CSS_FILES
+    )
+    # Make sure the inlined script cannot close its own <script> tag.
+    js = "\n".join(
+        minify_js((REVEALJS / f).read_text(encoding="utf-8"))
+        for f in JS_FILES
+    ).replace("</script", "<\\/script")
+    return css, js
+
+
+def render_bundle(jinja_env, setlist, max_workers=4):
+    """
+    Renders a slide bundle. Every song gets its own deck, and the whole
+    setlist is also rendered as a single deck, `index.html`.
+
+    Songs are rendered in parallel. The template does not depend on the
+    request, so no app context is needed in the worker threads.
+
+    :param jinja_env: The app's Jinja environment.
+    :param setlist: A list of `(song, arrangement)` tuples, where `song` is a
+        `dict` with cleaned lyrics (see `app.load_setlist`).
+    :returns: A `dict` of relative path to file contents.
+    """
+    css, js = load_assets()
+    template = jinja_env.get_template(BUNDLE_TEMPLATE)
+
+    def render(title, songs):
+        return template.render(title=title, songs=songs, css=css, js=js)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        decks = pool.map(
+            lambda item: render(item[0]["name"], [item]), setlist
+        )
+        index = pool.submit(render, "Worship", setlist)
+        files = {
+            f"songs/{song['id']}.html": deck
+            for (song, _), deck in zip(setlist, decks)
+        }
+        files["index.html"] = index.result()
+    return files
+
+
+def write_bundle(files, out):
+    """
+    Writes a rendered bundle to disk.
+
+    :param files: A `dict` of relative path to file contents, as returned by
+        `render_bundle`.
+    :param out: A directory, or a path ending in `.zip` to write a zip file.
+        Also accepts a file-like object, which gets a zip file.
+    """
+    if not isinstance(out, (str, Path)) or str(out).endswith(".zip"):
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+            for path, contents in files.items():
+                zf.writestr(path, contents)
+        return
+    out = Path(out)
+    for path, contents in files.items():
+        target = out / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(contents, encoding="utf-8")
@@ -0,0 +1,104 @@
+"""
+In-process caches for rendered pages.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CacheEntry = namedtuple("CacheEntry", ["version", "etag", "body", "created"])
+
+
+class RenderCache(object):
+    """
+    A bounded LRU cache of rendered pages, keyed by song id.
+
+    Every song has a content version, which `save_song` bumps through
+    `bump()`. An entry is only served while its version is current. Because
+    each gunicorn worker holds its own cache and only sees its own bumps,
+    entries also expire after `ttl` seconds, which bounds how stale a page
+    can be after another worker saved the song.
+
+    :attr stats: A `dict` of hit/miss/eviction counters.
+    """
+
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.versions = dict()
+        self.stats = dict(hits=0, misses=0, evictions=0, invalidations=0)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Drops every entry and version, and resets the counters.
+        """
+        with self._lock:
+            self.entries.clear()
+            self.versions.clear()
+            self.stats = dict.fromkeys(self.stats, 0)
+
+    def bump(self, key):
+        """
+        Marks the content of `key` as changed, invalidating its entry.
+        """
+        with self._lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            if self.entries.pop(key, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def version(self, key):
+        """
+        :returns: The current content version of `key`. Read this before
+            rendering, and pass it to `put()`.
+        """
+        with self._lock:
+            return self.versions.get(key, 0)
+
+    def get(self, key):
+        """
+        :returns: The current `CacheEntry` for `key`, or `None`.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if (
+                entry is None
+                or entry.version != self.versions.get(key, 0)
+                or time.monotonic() - entry.created > self.ttl
+            ):
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key, body, version):
+        """
+        Stores a rendered page.
+
+        :param body: The rendered page.
+        :type body: `str`
+        :param version: The content version the page was rendered from, as
+            returned by `version()`. If the song was saved in the meantime,
+            the page is not stored.
+        :returns: The new `CacheEntry`, whose `etag` is a hash of `body`.
+        """
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        entry = CacheEntry(version, etag, body, time.monotonic())
+        with self._lock:
+            if version != self.versions.get(key, 0):
+                return entry
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return entry
+
+    def info(self):
+        """
+        :returns: The counters plus the current number of entries.
+        """
+        with self._lock:
+            return dict(self.stats, size=len(self.entries))
@@ -0,0 +1,260 @@
+"""
+Database-backed song search.
+
+Songs are mirrored into a `song_search` side table that the database itself
+indexes, so that every gunicorn worker shares one index:
+
+- On PostgreSQL, the table has a generated `tsvector` column and a `pg_trgm`
+  trigram index, both GIN-indexed. Filtering and ranking happen in Postgres.
+  Postgres' text search does not split Chinese into words, so the
+  `tsvector` is built from the terms of the in-process index instead
+  (character unigrams and bigrams, and latin words; see `search_terms`),
+  and queries are split the same way (see `search_query`). That way even
+  one- and two-character queries are answered from the index.
+- On SQLite (for local testing), the table is an FTS5 virtual table using the
+  trigram tokenizer.
+
+Enable it by setting `SEARCH_BACKEND=database`, then run `flask init-search`
+once to create and fill the table.
+"""
+from sqlalchemy import text
+
+from .search import WORD_RE, index_terms, query_terms, song_fields
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    CREATE TABLE IF NOT EXISTS song_search (
+        song_id INTEGER PRIMARY KEY REFERENCES song (id) ON DELETE CASCADE,
+        title TEXT NOT NULL DEFAULT '',
+        content TEXT NOT NULL DEFAULT '',
+        title_terms TEXT NOT NULL DEFAULT '',
+        content_terms TEXT NOT NULL DEFAULT ''
+    )
+    """,
+    # Tables created before the tsvector was built from `search_terms`.
+    """
+    ALTER TABLE song_search
+    ADD COLUMN IF NOT EXISTS title_terms TEXT NOT NULL DEFAULT '',
+    ADD COLUMN IF NOT EXISTS content_terms TEXT NOT NULL DEFAULT ''
+    """,
+    "ALTER TABLE song_search DROP COLUMN IF EXISTS tsv",
+    # The terms are taken as they are, without Postgres' parser.
+    """
+    ALTER TABLE song_search ADD COLUMN tsv TSVECTOR GENERATED ALWAYS AS (
+        setweight(array_to_tsvector(string_to_array(title_terms, ' ')), 'A')
+        || setweight(
+            array_to_tsvector(string_to_array(content_terms, ' ')), 'B'
+        )
+    ) STORED
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS song_search_tsv_idx
+    ON song_search USING GIN (tsv)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS song_search_trgm_idx
+    ON song_search USING GIN (content gin_trgm_ops)
+    """,
+]
+
+SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS song_search
+    USING fts5(title, content, tokenize='trigram')
+    """
+]
+
+POSTGRES_UPSERT = text(
+    """
+    INSERT INTO song_search (song_id, title, content, title_terms,
+                             content_terms)
+    VALUES (:id, :title, :content, :title_terms, :content_terms)
+    ON CONFLICT (song_id) DO UPDATE
+    SET title = excluded.title,
+        content = excluded.content,
+        title_terms = excluded.title_terms,
+        content_terms = excluded.content_terms
+    """
+)
+
+POSTGRES_QUERY = """
+    SELECT song_id,
+           ts_rank(tsv, CAST(:tsq AS tsquery))
+           + word_similarity(:q, content)
+           + CASE WHEN title ILIKE :pattern THEN 1 ELSE 0 END AS score
+    FROM song_search
+    WHERE {where}
+    ORDER BY score DESC, song_id
+    LIMIT :limit
+"""
+POSTGRES_TSV_QUERY = text(
+    POSTGRES_QUERY.format(where="tsv @@ CAST(:tsq AS tsquery)")
+)
+# Substrings that are not whole terms (e.g. the middle of a pinyin word) are
+# found with the trigram index, which needs at least three characters.
+POSTGRES_TRGM_QUERY = text(
+    POSTGRES_QUERY.format(
+        where="tsv @@ CAST(:tsq AS tsquery) OR content ILIKE :pattern"
+    )
+)
+
+SQLITE_MATCH_QUERY = text(
+    """
+    SELECT rowid, -bm25(song_search, 4.0, 1.0) AS score
+    FROM song_search
+    WHERE song_search MATCH :match
+    ORDER BY score DESC, rowid
+    LIMIT :limit
+    """
+)
+
+# The trigram tokenizer cannot MATCH terms shorter than three characters, so
+# those fall back to a LIKE scan over the (small) FTS table.
+SQLITE_LIKE_QUERY = text(
+    """
+    SELECT rowid, (title LIKE :pattern ESCAPE '\\') + 1.0 AS score
+    FROM song_search
+    WHERE content LIKE :pattern ESCAPE '\\'
+    ORDER BY score DESC, rowid
+    LIMIT :limit
+    """
+)
+
+
+def _dialect(session):
+    return session.get_bind().dialect.name
+
+
+def _like_pattern(q):
+    escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def search_document(song):
+    """
+    Flattens a song into the `(title, content)` text that gets indexed.
+
+    `title` holds the name, pinyin and pinyin initials, which rank higher;
+    `content` holds every searchable field, lyrics included.
+    """
+    fields = song_fields(song)
+    title = f"{fields['name']}\n{fields['pinyin']}\n{fields['initials']}"
+    content = "\n".join(fields.values())
+    return title, content
+
+
+def search_terms(text):
+    """
+    :returns: The terms that `search.index_terms` indexes `text` under,
+        space-separated, without the prefixes of latin words (the query
+        matches those as prefixes instead).
+    """
+    terms = (term for term, weight in index_terms(text) if weight == 1.0)
+    return " ".join(dict.fromkeys(terms))
+
+
+def search_query(q):
+    """
+    :returns: A `tsquery` matching songs that have every term of `q`, as
+        split by `search.query_terms`. Latin terms match as prefixes.
+    """
+    terms = []
+    for term in query_terms(q):
+        if WORD_RE.fullmatch(term):
+            terms.append(f"'{term}':*")
+        else:
+            terms.append(f"'{term}'")
+    return " & ".join(terms)
+
+
+def create_search_tables(session):
+    """
+    Creates the `song_search` table and its indexes, if they do not exist.
+    """
+    ddl = POSTGRES_DDL if _dialect(session) == "postgresql" else SQLITE_DDL
+    for statement in ddl:
+        session.execute(text(statement))
+    session.commit()
+
+
+def sync_songs(session, songs):
+    """
+    Writes songs into the search table. Does not commit, so that the search
+    table is updated in the same transaction as the songs themselves.
+
+    :param songs: An iterable of `Song` objects.
+    """
+    rows = []
+    for song in songs:
+        title, content = search_document(song)
+        rows.append(dict(id=song.id, title=title, content=content))
+    if not rows:
+        return
+    if _dialect(session) == "postgresql":
+        for row in rows:
+            row["title_terms"] = search_terms(row["title"])
+            row["content_terms"] = search_terms(row["content"])
+        session.execute(POSTGRES_UPSERT, rows)
+    else:
+        session.execute(
+            text("DELETE FROM song_search WHERE rowid = :id"),
+            [dict(id=r["id"]) for r in rows],
+        )
+        session.execute(
+            text(
+                "INSERT INTO song_search (rowid, title, content) "
+                "VALUES (:id, :title, :content)"
+            ),
+            rows,
+        )
+
+
+def unsync_songs(session, ids):
+    """
+    Removes deleted songs from the search table. Does not commit. (On
+    PostgreSQL, deleting a song already cascades to its row.)
+
+    :param ids: The ids of the deleted songs.
+    """
+    if ids and _dialect(session) != "postgresql":
+        session.execute(
+            text("DELETE FROM song_search WHERE rowid = :id"),
+            [dict(id=id) for id in ids],
+        )
+
+
+def search_songs(session, q, limit=50):
+    """
+    Searches songs in the database.
+
+    :param q: The search query.
+    :type q: `str`
+    :param limit: The maximum number of results to return.
+    :type limit: `int`
+    :returns: A list of `(song_id, score)` tuples, best match first.
+    """
+    q = q.strip()
+    if not q:
+        return []
+
+    if _dialect(session) == "postgresql":
+        params = dict(
+            q=q, tsq=search_query(q), pattern=_like_pattern(q), limit=limit
+        )
+        query = POSTGRES_TRGM_QUERY if len(q) >= 3 else POSTGRES_TSV_QUERY
+        rows = session.execute(query, params)
+    else:
+        words = q.split()
+        if all(len(w) >= 3 for w in words):
+            match = " AND ".join(
+                '"{}"'.format(w.replace('"', '""')) for w in words
+            )
+            rows = session.execute(
+                SQLITE_MATCH_QUERY, dict(match=match, limit=limit)
+            )
+        else:
+            rows = session.execute(
+                SQLITE_LIKE_QUERY, dict(pattern=_like_pattern(q), limit=limit)
+            )
+    return [(int(id), float(score)) for id, score in rows]
@@ -1,9 +1,7 @@
 from pathlib import Path
 from dotenv import load_dotenv
 import os
-import boto3
-from hanziconv import HanziConv
-from functools import partial
+from .hanzi import TraditionalConverter
 
 root = Path(".")
 dotenv_path = root / ".env"
@@ -13,12 +11,64 @@ if dotenv_path.exists():
 # Instantiate connection to the database on Heroku
 DB_URL = os.getenv("DATABASE_URL")
 
-# Instantiate s3 bucket
-s3 = boto3.resource("s3")
+# The s3 bucket holding sheet music. The client itself is created lazily,
+# see `app.s3`.
 bucket = os.getenv("S3_BUCKET_NAME")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 10))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 5))
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", 8 * 1024 * 1024))
+
+# How sheet music is delivered: "proxy" sends the bytes through the web
+# worker, "presigned" redirects the browser to a short-lived s3 URL.
+SHEET_MUSIC_DELIVERY = os.getenv("SHEET_MUSIC_DELIVERY", "proxy")
+PRESIGNED_URL_TTL = int(os.getenv("PRESIGNED_URL_TTL", 300))
+
+# Local cache of sheet music downloaded from s3, see `app.sheet_cache`.
+SHEET_CACHE_DIR = os.getenv("SHEET_CACHE_DIR", "/tmp/sheet-music")
+SHEET_CACHE_BYTES = int(os.getenv("SHEET_CACHE_BYTES", 512 * 1024 * 1024))
+
+# First-page previews of sheet music, see `app.previews`.
+PREVIEW_DIR = os.getenv("PREVIEW_DIR", "/tmp/sheet-music-previews")
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", os.cpu_count() or 1))
+
+# Offline mode, for running the app from a local snapshot (see `flask
+# snapshot`) where there is no network: point DATABASE_URL at the snapshot's
+# SQLite file, and sheet music and previews are served from SHEET_MUSIC_DIR.
+# The app is read-only in this mode.
+OFFLINE = os.getenv("OFFLINE", "") == "1"
+SHEET_MUSIC_DIR = os.getenv("SHEET_MUSIC_DIR", "sheet-music")
+
+# Number of songs shown per page on the song listing.
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 500))
+
+# Rendered slides are cached per worker for at most this many seconds.
+SLIDES_CACHE_SIZE = int(os.getenv("SLIDES_CACHE_SIZE", 256))
+SLIDES_CACHE_TTL = float(os.getenv("SLIDES_CACHE_TTL", 60))
+
+# Background jobs: "memory" keeps them in each worker, "database" in the
+# `job` table (create it with `flask init-jobs`).
+JOBS_BACKEND = os.getenv("JOBS_BACKEND", "memory")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+
+# Send uploaded sheet music to s3 in the background, rather than during the
+# upload request.
+ASYNC_UPLOADS = os.getenv("ASYNC_UPLOADS", "") == "1"
+
+# Count the SQL statements of every request (always on in debug mode), see
+# `app.querycount`.
+QUERY_COUNTER = os.getenv("QUERY_COUNTER", "") == "1"
+
+# Where song search runs: "memory" for a per-process inverted index, or
+# "database" for Postgres full-text/trigram search (SQLite FTS5 locally).
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "memory")
+
+# The memory search index picks up songs saved by other workers after at
+# most this many seconds.
+SEARCH_INDEX_TTL = float(os.getenv("SEARCH_INDEX_TTL", 30))
 
 # Commonly-used text conversion
-hzc = HanziConv()
 custom_mapping = {
     "祢": "祢",
     "袮": "祢",
@@ -56,4 +106,5 @@ custom_mapping = {
     "回": "回",
 }
 
-convert = partial(HanziConv.toTraditional, custom_mapping=custom_mapping)
+converter = TraditionalConverter(custom_mapping=custom_mapping)
+convert = converter.convert
@@ -0,0 +1,107 @@
+"""
+Writing the whole song library out, one song at a time.
+
+The formats are the ones `app.importer` reads back:
+
+- `jsonl`: one JSON object per line.
+- `yaml`: one YAML document per song.
+- `text`: songs separated by form feed lines, see `song_plaintext`.
+
+Every function here is a generator of `str` (or `bytes`) chunks, so that a
+library of any size can be exported in constant memory.
+"""
+import json
+import re
+import zlib
+
+import yaml
+
+from .utils import song_dict
+
+CONTENT_TYPES = {
+    "jsonl": "application/x-ndjson",
+    "yaml": "application/x-yaml",
+    "text": "text/plain",
+}
+EXTENSIONS = {"jsonl": "jsonl", "yaml": "yaml", "text": "txt"}
+
+# Compressed output is sent on in chunks of about this many bytes.
+GZIP_CHUNK_SIZE = 64 * 1024
+
+
+def format_for(filename):
+    """
+    :returns: The export format matching a file name, ignoring any `.gz`.
+        Defaults to "jsonl".
+    """
+    name = filename[:-3] if filename.endswith(".gz") else filename
+    ext = name.rsplit(".", 1)[-1].lower()
+    if ext in ("yaml", "yml"):
+        return "yaml"
+    if ext == "txt":
+        return "text"
+    return "jsonl"
+
+
+def export_records(songs, fmt):
+    """
+    Serializes songs.
+
+    :param songs: An iterable of `Song` objects.
+    :param fmt: One of `CONTENT_TYPES`.
+    :returns: An iterator of `str`, one per song.
+    """
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f"Unknown export format {fmt!r}")
+    for i, song in enumerate(songs):
+        data = song_dict(song)
+        if fmt == "jsonl":
+            yield json.dumps(data, ensure_ascii=False) + "\n"
+        elif fmt == "yaml":
+            yield yaml.safe_dump(
+                data, allow_unicode=True, explicit_start=True, sort_keys=False
+            )
+        else:
+            text = song_plaintext(data)
+            yield text if i == 0 else "\f\n" + text
+
+
+def song_plaintext(data):
+    """
+    Writes a song in the `text` format: its name, then the layout of
+    `utils.lyrics_plaintext`, except that each lyrics section starts with a
+    `[section]` header line. That way sections may contain blank lines.
+    Lyrics lines that start with "[" get another "[" in front, so that they
+    cannot be mistaken for a header.
+
+    :param data: A song as returned by `utils.song_dict`.
+    :returns: The song as a `str`.
+    """
+    text = f"{data['name']}\n"
+    text += f"{data['default_arrangement'] or ''}\n\n\n\n"
+    text += f"{data['composer'] or ''}\n{data['copyright'] or ''}\n\n"
+    for section, words in (data["lyrics"] or dict()).items():
+        words = re.sub(r"^\[", "[[", words, flags=re.MULTILINE)
+        text += f"[{section}]\n{words}\n\n"
+    return text
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compresses a stream of `str` chunks into gzip, on the fly.
+
+    :returns: An iterator of `bytes`.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = []
+    size = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            pending.append(data)
+            size += len(data)
+        if size >= GZIP_CHUNK_SIZE:
+            yield b"".join(pending)
+            pending, size = [], 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
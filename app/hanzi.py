@@ -0,0 +1,95 @@
+"""
+Simplified-to-Traditional Chinese conversion.
+
+`HanziConv.toTraditional` looks every character up with `str.find` over a
+~2700-character string, which makes converting a song's lyrics cost
+O(len(text) * len(charmap)). Here the HanziConv tables and our own
+`custom_mapping` are compiled once into a single `str.translate` table, and
+results are memoized, since the same lyrics are converted on every save.
+"""
+import re
+from functools import lru_cache
+
+from hanziconv.charmap import simplified_charmap, traditional_charmap
+
+
+def build_table(custom_mapping=None):
+    """
+    Compiles the HanziConv character maps plus a custom mapping into a
+    `str.translate` table.
+
+    :param custom_mapping: A `dict` of single characters to their preferred
+        conversion, which takes precedence over HanziConv's.
+    :returns: A `dict` of code point to replacement string.
+    """
+    table = dict()
+    for s, t in zip(simplified_charmap, traditional_charmap):
+        # HanziConv uses the first match when a character appears twice.
+        if s != t:
+            table.setdefault(ord(s), t)
+    for s, t in (custom_mapping or {}).items():
+        if s == t:
+            # Characters that map to themselves must not be converted.
+            table.pop(ord(s), None)
+        else:
+            table[ord(s)] = t
+    return table
+
+
+class TraditionalConverter(object):
+    """
+    Converts text to Traditional Chinese.
+
+    :attr table: The compiled `str.translate` table.
+    :attr phrases: A `dict` of multi-character phrases that are replaced as a
+        whole before character-level conversion. Only used when given.
+    """
+
+    def __init__(self, custom_mapping=None, phrases=None, cache_size=4096):
+        self.table = build_table(custom_mapping)
+        self.phrases = dict(phrases or {})
+        self._phrase_re = None
+        if self.phrases:
+            # Longest phrases first, so that they win over their prefixes.
+            keys = sorted(self.phrases, key=len, reverse=True)
+            self._phrase_re = re.compile("|".join(map(re.escape, keys)))
+        self._cached = lru_cache(maxsize=cache_size)(self._convert)
+
+    def _convert(self, text):
+        if self._phrase_re is not None:
+            text = self._phrase_re.sub(
+                lambda m: self.phrases[m.group(0)], text
+            )
+        return text.translate(self.table)
+
+    def convert(self, text):
+        """
+        Converts `text` to Traditional Chinese.
+
+        :param text: The text to convert.
+        :type text: `str` or `bytes`
+        :returns: The converted text.
+        :rtype: `str`
+        """
+        if isinstance(text, bytes):
+            text = text.decode("utf-8")
+        return self._cached(text)
+
+    __call__ = convert
+
+    def convert_many(self, texts):
+        """
+        Converts many pieces of text at once. Repeated texts are only
+        converted once.
+
+        :param texts: An iterable of `str`.
+        :returns: A list of converted texts, in the same order.
+        :rtype: `list(str)`
+        """
+        return [self.convert(t) for t in texts]
+
+    def cache_info(self):
+        """
+        :returns: The LRU cache statistics.
+        """
+        return self._cached.cache_info()
@@ -0,0 +1,256 @@
+"""
+Reading songs from import files.
+
+Three formats are understood:
+
+- `yaml`: the old `export_database` dump of the TinyDB `song.db` (a
+  `{"_default": {"1": {...}, ...}}` mapping), a list of songs, or one song
+  per YAML document.
+- `jsonl`: one JSON object per line.
+- `text`: songs separated by form feed (`\\f`) lines. Each song is its name
+  on the first line, followed by the layout of `utils.lyrics_plaintext`,
+  except that each lyrics section starts with a `[section]` header line
+  (see `exporter.song_plaintext`), so that sections may contain blank
+  lines. Files without header lines are read as `lyrics_plaintext` output,
+  with sections separated by blank lines.
+
+Records are read lazily, so that large files are never held in memory (bar
+the single-document YAML dump, which has to be parsed whole).
+"""
+import io
+import json
+import re
+import time
+
+import yaml
+
+from .utils import clean_arrangement
+
+FORMATS = ("yaml", "jsonl", "text")
+
+# Fields that may be imported, and that must be text if they are given.
+TEXT_FIELDS = (
+    "name",
+    "composer",
+    "copyright",
+    "ccli",
+    "default_arrangement",
+    "youtube",
+)
+
+
+# A section header line of the `text` format. Lyrics lines that start with
+# "[" are written with another "[" in front, so they never match.
+SECTION_HEADER = re.compile(r"^\[([^\[\n][^\n]*)\]\n", re.MULTILINE)
+
+
+def guess_format(filename):
+    """
+    :returns: The import format matching a file's extension.
+    """
+    ext = filename.rsplit(".", 1)[-1].lower()
+    if ext in ("yaml", "yml", "db"):
+        return "yaml"
+    if ext in ("jsonl", "ndjson", "json"):
+        return "jsonl"
+    return "text"
+
+
+def read_records(fileobj, fmt):
+    """
+    Yields the songs in an import file.
+
+    :param fileobj: A text or binary file-like object.
+    :param fmt: One of `FORMATS`.
+    :returns: An iterator of `(ref, record)` tuples, where `ref` says where
+        the record came from (for error reports) and `record` is a `dict`,
+        or a `ValueError` if the record could not be parsed.
+    """
+    if isinstance(fileobj.read(0), bytes):
+        fileobj = io.TextIOWrapper(fileobj, encoding="utf-8-sig")
+    if fmt == "yaml":
+        return _read_yaml(fileobj)
+    if fmt == "jsonl":
+        return _read_jsonl(fileobj)
+    if fmt == "text":
+        return _read_text(fileobj)
+    raise ValueError(f"Unknown import format {fmt!r}")
+
+
+def _read_yaml(fileobj):
+    for doc_no, doc in enumerate(yaml.safe_load_all(fileobj), 1):
+        if isinstance(doc, list):
+            for i, record in enumerate(doc, 1):
+                yield f"document {doc_no}, song {i}", record
+        elif isinstance(doc, dict) and "name" in doc:
+            yield f"document {doc_no}", doc
+        elif isinstance(doc, dict):
+            # TinyDB: {table: {doc_id: song}}, or just {doc_id: song}.
+            tables = doc.values()
+            if not all(
+                isinstance(t, dict)
+                and all(isinstance(r, dict) for r in t.values())
+                for t in tables
+            ):
+                tables = [doc]
+            for table in tables:
+                for doc_id, record in table.items():
+                    yield f"song {doc_id}", record
+        elif doc is not None:
+            yield f"document {doc_no}", ValueError("Not a song")
+
+
+def _read_jsonl(fileobj):
+    for line_no, line in enumerate(fileobj, 1):
+        if not line.strip():
+            continue
+        try:
+            yield f"line {line_no}", json.loads(line)
+        except json.JSONDecodeError as e:
+            yield f"line {line_no}", ValueError(f"Invalid JSON: {e}")
+
+
+def _read_text(fileobj):
+    lines = []
+    start = 1
+    for line_no, line in enumerate(fileobj, 1):
+        if line.strip("\r\n") == "\f":
+            if "".join(lines).strip():
+                yield f"line {start}", parse_plaintext("".join(lines))
+            lines = []
+            start = line_no + 1
+        else:
+            lines.append(line)
+    if "".join(lines).strip():
+        yield f"line {start}", parse_plaintext("".join(lines))
+
+
+def parse_plaintext(text):
+    """
+    Parses one song in the `text` format: its name, then the layout of
+    `utils.lyrics_plaintext`, with `[section]` header lines.
+
+    :returns: The song as a `dict`, or a `ValueError`.
+    """
+    lines = text.replace("\r\n", "\n").lstrip("\n").split("\n")
+    if len(lines) < 7 or any(lines[i].strip() for i in (2, 3, 4)):
+        return ValueError("Expected a name and arrangement, then 3 blanks")
+    name, arrangement, _, _, _, composer, copyright = lines[:7]
+    body = "\n".join(lines[7:])
+    if SECTION_HEADER.search(body):
+        lyrics = parse_sections(body)
+        if isinstance(lyrics, ValueError):
+            return lyrics
+    else:
+        # Plain `lyrics_plaintext`: sections cannot contain blank lines.
+        lyrics = dict()
+        for block in body.split("\n\n"):
+            if block.strip():
+                section, _, words = block.strip("\n").partition("\n")
+                lyrics[section.strip()] = words
+    return dict(
+        name=name.strip(),
+        default_arrangement=arrangement.strip(),
+        composer=composer.strip(),
+        copyright=copyright.strip(),
+        lyrics=lyrics,
+    )
+
+
+def parse_sections(body):
+    """
+    Parses the lyrics of a song in the `text` format: each section is a
+    `[section]` header line, its text, and a blank line.
+
+    :returns: The lyrics as a `dict`, or a `ValueError`.
+    """
+    parts = SECTION_HEADER.split(body)
+    if parts[0].strip():
+        return ValueError("Expected a [section] line before the lyrics")
+    lyrics = dict()
+    for section, words in zip(parts[1::2], parts[2::2]):
+        if words.endswith("\n\n"):
+            words = words[:-2]
+        else:
+            words = words.rstrip("\n")
+        lyrics[section] = re.sub(r"^\[(?=\[)", "", words, flags=re.MULTILINE)
+    return lyrics
+
+
+def validate_record(record):
+    """
+    Checks that an imported record describes a song.
+
+    :returns: The record reduced to the fields that are imported.
+    :raises ValueError: If the record is not a valid song.
+    """
+    if isinstance(record, ValueError):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError("Not a song")
+    song = dict()
+    for field in TEXT_FIELDS:
+        value = record.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, (str, int)):
+            raise ValueError(f"{field} must be text")
+        song[field] = str(value)
+    if not song.get("name", "").strip():
+        raise ValueError("Missing name")
+    song["name"] = song["name"].strip()
+
+    lyrics = record.get("lyrics") or dict()
+    if not isinstance(lyrics, dict) or not all(
+        isinstance(v, str) for v in lyrics.values()
+    ):
+        raise ValueError("lyrics must map section names to text")
+    song["lyrics"] = {str(k): v for k, v in lyrics.items()}
+
+    missing = [
+        s
+        for s in clean_arrangement(song.get("default_arrangement", ""))
+        if s and s not in song["lyrics"]
+    ]
+    if missing:
+        raise ValueError(f"Arrangement has unknown sections: {missing}")
+    return song
+
+
+class ImportReport(object):
+    """
+    Counts what an import did, for printing or returning as JSON.
+
+    :attr imported: The number of songs imported.
+    :attr errors: A list of `(ref, message)` tuples, one per rejected record.
+    """
+
+    def __init__(self):
+        self.imported = 0
+        self.errors = []
+        self.started = time.monotonic()
+
+    def error(self, ref, message):
+        self.errors.append((ref, str(message)))
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def to_dict(self):
+        return dict(
+            imported=self.imported,
+            rejected=len(self.errors),
+            seconds=round(self.elapsed, 3),
+            songs_per_second=round(self.imported / (self.elapsed or 1), 1),
+            errors=[dict(ref=r, error=m) for r, m in self.errors],
+        )
+
+    def __str__(self):
+        lines = [f"{ref}: {message}" for ref, message in self.errors]
+        lines.append(
+            f"Imported {self.imported} songs, rejected {len(self.errors)}, "
+            f"in {self.elapsed:.1f}s "
+            f"({self.imported / (self.elapsed or 1):.0f} songs/s)."
+        )
+        return "\n".join(lines)
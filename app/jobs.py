@@ -0,0 +1,335 @@
+"""
+A small background job queue for slow I/O (e.g. uploads to s3), so that
+request handlers can return without waiting for it.
+
+Jobs are recorded in a store, run on a thread pool, and retried with
+exponential backoff when they fail. Two stores are provided:
+
+- `MemoryJobStore` keeps jobs in this process only.
+- `DatabaseJobStore` keeps them in a `job` table, so that their status is
+  visible to every worker and queued jobs survive a restart (see
+  `JobQueue.resume`).
+"""
+import json
+import logging as log
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    insert,
+    select,
+    update,
+)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JOB_FIELDS = (
+    "id",
+    "name",
+    "args",
+    "status",
+    "attempts",
+    "error",
+    "created",
+    "updated",
+)
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class MemoryJobStore(object):
+    """
+    Keeps jobs in a `dict`, for a single process.
+    """
+
+    def __init__(self):
+        self.jobs = dict()
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def add(self, name, args):
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            now = _now()
+            self.jobs[job_id] = dict(
+                id=job_id,
+                name=name,
+                args=args,
+                status=QUEUED,
+                attempts=0,
+                error=None,
+                created=now,
+                updated=now,
+            )
+            return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def claim(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] != QUEUED:
+                return None
+            job.update(status=RUNNING, attempts=job["attempts"] + 1)
+            job["updated"] = _now()
+            return dict(job)
+
+    def finish(self, job_id, status, error=None):
+        with self._lock:
+            self.jobs[job_id].update(
+                status=status, error=error, updated=_now()
+            )
+
+    def queued(self):
+        with self._lock:
+            jobs = self.jobs.values()
+            return [j["id"] for j in jobs if j["status"] == QUEUED]
+
+    def recent(self, limit=50):
+        with self._lock:
+            jobs = sorted(self.jobs.values(), key=lambda j: -j["id"])
+            return [dict(j) for j in jobs[:limit]]
+
+
+class DatabaseJobStore(object):
+    """
+    Keeps jobs in a `job` table. Jobs are claimed with a conditional UPDATE,
+    so that only one worker runs each job.
+
+    :param engine: A SQLAlchemy engine.
+    """
+
+    metadata = MetaData()
+    table = Table(
+        "job",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String, nullable=False),
+        Column("args", Text, nullable=False),
+        Column("status", String, nullable=False, index=True),
+        Column("attempts", Integer, nullable=False, default=0),
+        Column("error", Text, nullable=True),
+        Column("created", DateTime, nullable=False),
+        Column("updated", DateTime, nullable=False),
+    )
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def create(self):
+        """
+        Creates the `job` table if it does not exist.
+        """
+        self.metadata.create_all(self.engine)
+
+    def _row(self, row):
+        job = dict(zip(JOB_FIELDS, row))
+        job["args"] = json.loads(job["args"])
+        return job
+
+    def add(self, name, args):
+        now = _now()
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                insert(self.table).values(
+                    name=name,
+                    args=json.dumps(args),
+                    status=QUEUED,
+                    attempts=0,
+                    created=now,
+                    updated=now,
+                )
+            )
+            return result.inserted_primary_key[0]
+
+    def get(self, job_id):
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(self.table).where(self.table.c.id == job_id)
+            ).first()
+        return self._row(row) if row is not None else None
+
+    def claim(self, job_id):
+        t = self.table
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(t)
+                .where(t.c.id == job_id, t.c.status == QUEUED)
+                .values(
+                    status=RUNNING, attempts=t.c.attempts + 1, updated=_now()
+                )
+            )
+            if result.rowcount != 1:
+                return None
+            row = conn.execute(select(t).where(t.c.id == job_id)).first()
+        return self._row(row)
+
+    def finish(self, job_id, status, error=None):
+        t = self.table
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(t)
+                .where(t.c.id == job_id)
+                .values(status=status, error=error, updated=_now())
+            )
+
+    def queued(self):
+        t = self.table
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(t.c.id).where(t.c.status == QUEUED).order_by(t.c.id)
+            )
+            return [id for id, in rows]
+
+    def recent(self, limit=50):
+        t = self.table
+        with self.engine.connect() as conn:
+            query = select(t).order_by(t.c.id.desc()).limit(limit)
+            rows = conn.execute(query)
+            return [self._row(row) for row in rows]
+
+
+class JobQueue(object):
+    """
+    Runs registered tasks in the background.
+
+    :example:
+    >>> queue = JobQueue(MemoryJobStore())
+    >>> @queue.task("greet")
+    ... def greet(name):
+    ...     print(f"Hello {name}")
+    >>> job_id = queue.enqueue("greet", name="world")
+
+    :param store: Where jobs are recorded.
+    :param max_workers: The number of worker threads.
+    :param max_attempts: How many times a failing job is tried in total.
+    :param backoff: Seconds to wait before the first retry; doubled after
+        every further failure.
+    :param context: A function returning a context manager that every job
+        runs in, e.g. `app.app_context`.
+    """
+
+    def __init__(
+        self, store, max_workers=2, max_attempts=3, backoff=5, context=None
+    ):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.context = context
+        self.tasks = dict()
+        self._max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # Created on first use, so that no threads are started at import
+        # time (before gunicorn forks its workers).
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers,
+                    thread_name_prefix="job",
+                )
+            return self._executor
+
+    def task(self, name):
+        """
+        Registers a function as a task that can be enqueued by name. Its
+        arguments must be JSON-serializable.
+        """
+
+        def register(fn):
+            self.tasks[name] = fn
+            return fn
+
+        return register
+
+    def enqueue(self, name, **kwargs):
+        """
+        Records a job and schedules it to run.
+
+        :returns: The id of the job.
+        """
+        if name not in self.tasks:
+            raise KeyError(f"No task named {name!r}")
+        job_id = self.store.add(name, kwargs)
+        self.executor.submit(self.run, job_id)
+        return job_id
+
+    def status(self, job_id):
+        """
+        :returns: The job as a `dict`, or `None` if there is no such job.
+        """
+        return self.store.get(job_id)
+
+    def resume(self):
+        """
+        Schedules every queued job, e.g. the ones left over when the
+        previous process stopped.
+
+        :returns: The number of jobs scheduled.
+        """
+        job_ids = self.store.queued()
+        for job_id in job_ids:
+            self.executor.submit(self.run, job_id)
+        return len(job_ids)
+
+    def run(self, job_id):
+        """
+        Runs one job, if no other worker has claimed it yet. Failed jobs are
+        put back in the queue until they have been tried `max_attempts`
+        times.
+        """
+        job = self.store.claim(job_id)
+        if job is None:
+            return
+        try:
+            fn = self.tasks[job["name"]]
+            if self.context is not None:
+                with self.context():
+                    fn(**job["args"])
+            else:
+                fn(**job["args"])
+        except Exception:
+            error = traceback.format_exc()
+            log.warning(f"Job {job_id} ({job['name']}) failed:\n{error}")
+            if job["attempts"] >= self.max_attempts:
+                self.store.finish(job_id, FAILED, error)
+                return
+            self.store.finish(job_id, QUEUED, error)
+            delay = self.backoff * 2 ** (job["attempts"] - 1)
+            timer = threading.Timer(
+                delay, lambda: self.executor.submit(self.run, job_id)
+            )
+            timer.daemon = True
+            timer.start()
+        else:
+            self.store.finish(job_id, DONE)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads, waiting for running jobs if `wait`.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
@@ -0,0 +1,157 @@
+"""
+Keeps a local SQLite copy of the song library up to date from the server's
+change feed (`/changes`), e.g. on a projection laptop or at a second site.
+
+Only songs changed since the last sync are fetched, so a sync costs time in
+proportion to the number of changes rather than the size of the library.
+"""
+import json
+import logging as log
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from sqlalchemy import (
+    Column,
+    MetaData,
+    String,
+    Table,
+    cast,
+    delete,
+    select,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert
+
+# A song saved in a transaction that commits late can have an `updated_at`
+# that is slightly older than songs that were already sent. Each sync
+# starts this far before the last cursor to pick those up; re-sending a song
+# is harmless.
+OVERLAP = timedelta(seconds=10)
+
+
+def http_fetch(base_url, timeout=30):
+    """
+    :returns: A function that fetches a page of the change feed from the
+        server at `base_url`.
+    """
+
+    def fetch(since, limit):
+        params = dict(limit=limit)
+        if since:
+            params["since"] = since
+        url = f"{base_url.rstrip('/')}/changes?{urlencode(params)}"
+        with urlopen(url, timeout=timeout) as response:
+            return json.load(response)
+
+    return fetch
+
+
+class Mirror(object):
+    """
+    A local copy of the `song` table.
+
+    :param engine: A SQLAlchemy engine for the local SQLite database.
+    :param song_table: The app's `song` `Table`, so that the mirror has the
+        same schema and can be served by the app itself.
+    :param fetch: A function `fetch(since, limit)` returning a page of the
+        change feed as a `dict`; see `http_fetch`.
+    """
+
+    metadata = MetaData()
+    state = Table(
+        "mirror_state",
+        metadata,
+        Column("key", String, primary_key=True),
+        Column("value", String, nullable=False),
+    )
+
+    def __init__(self, engine, song_table, fetch):
+        self.engine = engine
+        self.song_table = song_table
+        self.fetch = fetch
+
+    def create(self):
+        """
+        Creates the mirror's tables if they do not exist.
+        """
+        self.song_table.create(self.engine, checkfirst=True)
+        self.metadata.create_all(self.engine)
+
+    def cursor(self):
+        """
+        :returns: The change feed cursor the mirror is up to date with, or
+            `None` if it has never been synced.
+        """
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(self.state.c.value).where(self.state.c.key == "cursor")
+            ).scalar()
+
+    def sync(self, limit=500):
+        """
+        Fetches and applies every change since the last sync. Each page is
+        applied in its own transaction, together with its cursor, so an
+        interrupted sync resumes where it stopped.
+
+        :returns: `(changed, deleted)`, the number of songs written and
+            deleted.
+        """
+        self.create()
+        since = self.cursor()
+        if since is not None and OVERLAP:
+            timestamp = datetime.fromisoformat(since.partition(",")[0])
+            since = f"{(timestamp - OVERLAP).isoformat()},0"
+        changed = deleted = 0
+        while True:
+            page = self.fetch(since, limit)
+            self.apply(page)
+            changed += len(page["songs"])
+            deleted += len(page["deleted"])
+            log.info(f"Mirrored {changed} changes and {deleted} deletions.")
+            since = page["next"] or since
+            if not page["more"]:
+                return changed, deleted
+
+    def apply(self, page):
+        """
+        Writes one page of the change feed.
+        """
+        t = self.song_table
+        rows = [
+            dict(song, updated_at=datetime.fromisoformat(song["updated_at"]))
+            for song in page["songs"]
+        ]
+        with self.engine.begin() as conn:
+            if page["deleted"]:
+                conn.execute(delete(t).where(t.c.id.in_(page["deleted"])))
+            for row in rows:
+                # Names are unique. If another song still has this one, it
+                # has been renamed since, and will arrive later in the feed.
+                conn.execute(
+                    update(t)
+                    .where(t.c.name == row["name"], t.c.id != row["id"])
+                    .values(name=t.c.name + " #" + cast(t.c.id, String))
+                )
+                values = {k: v for k, v in row.items() if k != "id"}
+                conn.execute(
+                    insert(t)
+                    .values(row)
+                    .on_conflict_do_update(index_elements=["id"], set_=values)
+                )
+            if page["next"]:
+                self.set_cursor(conn, page["next"])
+
+    def set_cursor(self, conn, cursor):
+        """
+        Records the change feed cursor the mirror is up to date with.
+
+        :param conn: A connection to the mirror, in a transaction.
+        """
+        conn.execute(
+            insert(self.state)
+            .values(key="cursor", value=cursor)
+            .on_conflict_do_update(
+                index_elements=["key"], set_=dict(value=cursor)
+            )
+        )
@@ -0,0 +1,224 @@
+"""
+First-page JPEG previews of sheet music.
+
+Previews are rendered with `pdftoppm` (from poppler), stored on S3 next to
+the sheet music under `previews/`, and cached on local disk. They are kept
+out of the `song` table, so that they do not bloat every query on it.
+
+Sheet music is stored under a hash of its contents, so the preview of a
+given key never changes and can be cached by browsers indefinitely.
+"""
+import logging as log
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from botocore.exceptions import ClientError
+
+from .env import bucket
+from .s3 import s3client
+
+PREVIEW_HEIGHT = 400
+
+CONTENT_KEY = re.compile(r"^[0-9a-f]{64}\.pdf$")
+
+# Previews that S3 does not have are not looked for again for this many
+# seconds, and at most this many misses are remembered.
+MISS_TTL = 300
+MAX_MISSES = 10000
+
+
+def available():
+    """
+    :returns: Whether previews can be rendered on this machine.
+    """
+    return shutil.which("pdftoppm") is not None
+
+
+def is_content_key(sheet_key):
+    """
+    :returns: Whether `sheet_key` is named after the hash of its contents
+        (see `s3.content_key`), rather than being an older, mutable name.
+    """
+    return CONTENT_KEY.match(sheet_key) is not None
+
+
+def preview_key(sheet_key):
+    """
+    :returns: The S3 key of the preview of a sheet music file.
+    """
+    return f"previews/{Path(sheet_key).stem}.jpg"
+
+
+def render_preview(pdf_path, jpeg_path, height=PREVIEW_HEIGHT):
+    """
+    Renders the first page of a PDF as a JPEG, `height` pixels high.
+
+    This is a plain function of file paths, so that it can run in a process
+    pool.
+
+    :param pdf_path: The PDF to render.
+    :param jpeg_path: Where to write the JPEG.
+    :returns: `jpeg_path`.
+    """
+    pdftoppm = shutil.which("pdftoppm")
+    if pdftoppm is None:
+        raise RuntimeError("pdftoppm (from poppler) is not installed.")
+    jpeg_path = Path(jpeg_path)
+    with tempfile.TemporaryDirectory(dir=jpeg_path.parent) as tmp:
+        prefix = os.path.join(tmp, "preview")
+        subprocess.run(
+            [
+                pdftoppm,
+                "-jpeg",
+                "-f",
+                "1",
+                "-l",
+                "1",
+                "-singlefile",
+                "-scale-to-y",
+                str(height),
+                "-scale-to-x",
+                "-1",
+                str(pdf_path),
+                prefix,
+            ],
+            check=True,
+            capture_output=True,
+            timeout=120,
+        )
+        os.replace(f"{prefix}.jpg", jpeg_path)
+    return jpeg_path
+
+
+class PreviewStore(object):
+    """
+    Finds, renders and caches previews.
+
+    :param root: The directory to cache previews in.
+    :param sheet_cache: The `SheetMusicCache` to get PDFs from.
+    :param remote: Whether to fetch previews that are not in `root` from
+        S3. If not, `root` is the only place previews are looked for.
+    :param miss_ttl: How long to remember that S3 has no preview for a key.
+    """
+
+    def __init__(self, root, sheet_cache, remote=True, miss_ttl=MISS_TTL):
+        self.root = Path(root)
+        self.sheet_cache = sheet_cache
+        self.remote = remote
+        self.miss_ttl = miss_ttl
+        self.misses = OrderedDict()
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, sheet_key):
+        """
+        :returns: Where the preview of `sheet_key` is cached locally.
+        """
+        if "/" in sheet_key or sheet_key.startswith("."):
+            raise ValueError(f"Invalid sheet music key: {sheet_key!r}")
+        return self.root / Path(preview_key(sheet_key)).name
+
+    def get(self, sheet_key):
+        """
+        Returns the local path of a preview, fetching it from S3 if it is not
+        cached yet.
+
+        A preview that S3 does not have is remembered as missing for
+        `miss_ttl` seconds, so that pages listing songs without previews do
+        not cost an S3 request per song each time.
+
+        :returns: The path, or `None` if the preview has not been rendered.
+        """
+        path = self.path(sheet_key)
+        if path.exists():
+            return path
+        if not self.remote:
+            return None
+        with self._lock:
+            expires = self.misses.get(sheet_key)
+        if expires is not None and time.monotonic() < expires:
+            return None
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".")
+        os.close(fd)
+        try:
+            s3client().download_file(bucket, preview_key(sheet_key), tmp)
+        except ClientError as e:
+            os.unlink(tmp)
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                self._missing(sheet_key)
+                return None
+            raise
+        os.replace(tmp, path)
+        with self._lock:
+            self.misses.pop(sheet_key, None)
+        return path
+
+    def _missing(self, sheet_key):
+        with self._lock:
+            self.misses.pop(sheet_key, None)
+            self.misses[sheet_key] = time.monotonic() + self.miss_ttl
+            while len(self.misses) > MAX_MISSES:
+                self.misses.popitem(last=False)
+
+    def generate(self, sheet_key):
+        """
+        Renders a preview and stores it on S3 and locally.
+
+        :returns: The local path of the preview.
+        """
+        pdf = self.sheet_cache.get(sheet_key)
+        path = render_preview(pdf, self.path(sheet_key))
+        self.upload(sheet_key)
+        return path
+
+    def upload(self, sheet_key):
+        """
+        Sends a locally rendered preview to S3.
+        """
+        s3client().upload_file(
+            str(self.path(sheet_key)),
+            bucket,
+            preview_key(sheet_key),
+            ExtraArgs={"ContentType": "image/jpeg"},
+        )
+
+    def generate_many(self, sheet_keys, max_workers=None, batch_size=32):
+        """
+        Renders previews for many sheet music files, in a process pool.
+
+        PDFs are fetched `batch_size` at a time, so that the sheet music
+        cache does not evict them before they are rendered.
+
+        :param sheet_keys: The keys to render previews for.
+        :returns: The number of previews rendered.
+        """
+        sheet_keys = list(sheet_keys)
+        rendered = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for start in range(0, len(sheet_keys), batch_size):
+                futures = []
+                for key in sheet_keys[start : start + batch_size]:
+                    try:
+                        pdf = self.sheet_cache.get(key)
+                    except Exception as e:
+                        log.warning(f"Could not fetch {key}: {e}")
+                        continue
+                    future = pool.submit(render_preview, pdf, self.path(key))
+                    futures.append((key, future))
+                for key, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        log.warning(f"Could not render {key}: {e}")
+                        continue
+                    self.upload(key)
+                    rendered += 1
+        return rendered
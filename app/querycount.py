@@ -0,0 +1,57 @@
+"""
+Counts the SQL statements each request runs, for checking that routes do
+not query the database more often than they need to.
+
+Active in debug mode (or with `QUERY_COUNTER=1`). Every response then gets
+an `X-Query-Count` header such as `SELECT=1, UPDATE=1`.
+"""
+import threading
+from collections import Counter
+
+from sqlalchemy import event
+
+
+class QueryCounter(object):
+    """
+    Counts statements by their first keyword, per thread.
+    """
+
+    def __init__(self):
+        self.engines = []
+        self._local = threading.local()
+
+    def install(self, engine):
+        """
+        Starts counting the statements run on `engine`.
+        """
+        if engine not in self.engines:
+            event.listen(engine, "before_cursor_execute", self._count)
+            self.engines.append(engine)
+
+    def start(self):
+        """
+        Starts a new count for the current thread (i.e. request).
+        """
+        self._local.counts = Counter()
+
+    def stop(self):
+        """
+        :returns: The counts since `start()`, as a `Counter` of statement
+            keyword (e.g. "SELECT") to number of statements.
+        """
+        counts = getattr(self._local, "counts", None)
+        self._local.counts = None
+        return counts or Counter()
+
+    def _count(self, conn, cursor, statement, parameters, context, many):
+        counts = getattr(self._local, "counts", None)
+        if counts is not None:
+            keyword = statement.lstrip().split(None, 1)[0].upper()
+            counts[keyword] += 1
+
+
+def format_counts(counts):
+    """
+    :returns: The counts as a header value, e.g. "SELECT=1, UPDATE=1".
+    """
+    return ", ".join(f"{k}={n}" for k, n in sorted(counts.items()))
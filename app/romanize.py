@@ -0,0 +1,75 @@
+"""
+Pinyin romanization of song names.
+
+`pinyin.get` formats a hex key and NFC-normalizes the result for every
+character on every call. Here the `pinyin` package's table is loaded once
+into a dict keyed by code point, and results are memoized, since the same
+names get romanized over and over.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+from pinyin.pinyin import pinyin_dict
+
+# Code point -> pinyin syllable without tone, e.g. ord("主") -> "zhu".
+PINYIN_TABLE = {
+    int(k, 16): unicodedata.normalize("NFC", v) for k, v in pinyin_dict.items()
+}
+
+WORD_RE = re.compile(r"[0-9A-Za-z]+")
+
+
+@lru_cache(maxsize=8192)
+def romanize(text, delimiter=" "):
+    """
+    Returns the pinyin of `text`, without tones. Characters without a pinyin
+    reading are kept as they are.
+
+    Gives the same result as `pinyin.get(text, format="strip",
+    delimiter=delimiter)`.
+
+    :example:
+    >>> romanize("主愛我")
+    'zhu ai wo'
+
+    :param text: The text to romanize.
+    :type text: `str`
+    :returns: The romanized text.
+    :rtype: `str`
+    """
+    return delimiter.join(PINYIN_TABLE.get(ord(c), c) for c in text)
+
+
+@lru_cache(maxsize=8192)
+def initials(text):
+    """
+    Returns the pinyin initials of `text`: the first letter of the reading of
+    every Chinese character, plus the first letter of every latin word.
+
+    :example:
+    >>> initials("主買我")
+    'zmw'
+    >>> initials("Amazing Grace 奇異恩典")
+    'agqyed'
+
+    :param text: The text to abbreviate.
+    :type text: `str`
+    :returns: The lower-cased initials.
+    :rtype: `str`
+    """
+    letters = []
+    pos = 0
+    while pos < len(text):
+        syllable = PINYIN_TABLE.get(ord(text[pos]))
+        if syllable:
+            letters.append(syllable[0])
+            pos += 1
+            continue
+        word = WORD_RE.match(text, pos)
+        if word:
+            letters.append(word.group(0)[0])
+            pos = word.end()
+        else:
+            pos += 1
+    return "".join(letters).lower()
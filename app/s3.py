@@ -0,0 +1,353 @@
+"""
+S3 utility functions for storing sheet music.
+
+Every worker process shares a single S3 client, created the first time it is
+needed. boto3 clients are thread-safe, and the client keeps a connection pool
+of `env.S3_MAX_POOL_CONNECTIONS` connections, so repeated uploads and
+downloads do not pay for building a client or a TLS connection each time.
+"""
+import hashlib
+import logging as log
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .env import (
+    bucket,
+    S3_MAX_POOL_CONNECTIONS,
+    S3_MAX_ATTEMPTS,
+    PRESIGNED_URL_TTL,
+    S3_PART_SIZE,
+)
+from .utils import content_disposition
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+
+def s3client():
+    """
+    Returns this process' S3 client, creating it on first use.
+
+    The client is re-created after a fork (e.g. when gunicorn preloads the
+    app), since connection pools must not be shared between processes.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                retries = dict(max_attempts=S3_MAX_ATTEMPTS, mode="standard")
+                config = Config(
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    retries=retries,
+                )
+                _client = boto3.session.Session().client("s3", config=config)
+                _client_pid = os.getpid()
+    return _client
+
+
+def reset_s3client():
+    """
+    Forgets the S3 client, so that the next call creates a new one.
+    """
+    global _client
+    with _lock:
+        _client = None
+
+
+class PresignedURLCache(object):
+    """
+    Caches presigned download URLs until shortly before they expire, so that
+    repeated downloads of the same file do not sign a new URL every time.
+
+    :attr ttl: How long, in seconds, each URL is valid for.
+    :attr margin: URLs are replaced once they have less than this many
+        seconds left, so that a client never receives an expired URL.
+    """
+
+    def __init__(self, ttl, margin=None, maxsize=1024):
+        self.ttl = ttl
+        self.margin = ttl / 5 if margin is None else margin
+        self.maxsize = maxsize
+        self.urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, download_name):
+        """
+        Returns a presigned URL that downloads `key` as `download_name`.
+
+        :param key: The s3 key of the file.
+        :param download_name: The name to save the file as.
+        :rtype: `str`
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self.urls.get((key, download_name))
+            if cached is not None and cached[1] - now > self.margin:
+                self.urls.move_to_end((key, download_name))
+                return cached[0]
+
+        url = s3client().generate_presigned_url(
+            "get_object",
+            Params=dict(
+                Bucket=bucket,
+                Key=key,
+                ResponseContentType="application/pdf",
+                ResponseContentDisposition=content_disposition(download_name),
+            ),
+            ExpiresIn=int(self.ttl),
+        )
+        with self._lock:
+            self.urls[(key, download_name)] = (url, now + self.ttl)
+            self.urls.move_to_end((key, download_name))
+            while len(self.urls) > self.maxsize:
+                self.urls.popitem(last=False)
+        return url
+
+
+presigned_urls = PresignedURLCache(PRESIGNED_URL_TTL)
+
+
+def s3ul(fpath, fname):
+    """
+    Uploads a file to S3.
+    """
+    s3client().upload_file(
+        fpath, bucket, fname, ExtraArgs={"ACL": "public-read"}
+    )
+
+
+def s3ul_stream(fileobj, fname, part_size=S3_PART_SIZE):
+    """
+    Uploads a file-like object to S3 without writing it to disk first.
+
+    The file is read `part_size` bytes at a time and sent as a multipart
+    upload, so memory use stays bounded whatever the size of the file. Files
+    smaller than one part are sent with a single `put_object` instead.
+
+    :param fileobj: A readable binary file-like object.
+    :param fname: The S3 key to upload to.
+    :param part_size: The size of each part; S3 requires at least 5 MiB.
+    :returns: `(sha256, size)`: the hex SHA-256 of the contents and their
+        size in bytes, computed while streaming.
+    """
+    client = s3client()
+    extra = dict(ACL="public-read", ContentType="application/pdf")
+    sha256 = hashlib.sha256()
+
+    chunk = fileobj.read(part_size)
+    sha256.update(chunk)
+    size = len(chunk)
+    if len(chunk) < part_size:
+        client.put_object(Bucket=bucket, Key=fname, Body=chunk, **extra)
+        return sha256.hexdigest(), size
+
+    upload = client.create_multipart_upload(Bucket=bucket, Key=fname, **extra)
+    upload_id = upload["UploadId"]
+    parts = []
+    try:
+        while chunk:
+            part = client.upload_part(
+                Bucket=bucket,
+                Key=fname,
+                UploadId=upload_id,
+                PartNumber=len(parts) + 1,
+                Body=chunk,
+            )
+            parts.append(dict(PartNumber=len(parts) + 1, ETag=part["ETag"]))
+            chunk = fileobj.read(part_size)
+            sha256.update(chunk)
+            size += len(chunk)
+        client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=fname,
+            UploadId=upload_id,
+            MultipartUpload=dict(Parts=parts),
+        )
+    except BaseException:
+        client.abort_multipart_upload(
+            Bucket=bucket, Key=fname, UploadId=upload_id
+        )
+        raise
+    return sha256.hexdigest(), size
+
+
+def s3exists(fname):
+    """
+    Checks whether a file exists on s3.
+    """
+    try:
+        s3client().head_object(Bucket=bucket, Key=fname)
+    except ClientError as e:
+        if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+            return False
+        raise
+    return True
+
+
+def s3touch(fname):
+    """
+    Refreshes the LastModified time of a file on s3 by copying it onto
+    itself, so that `gc-sheet-music` counts it as newly uploaded.
+
+    :returns: Whether the file exists.
+    """
+    try:
+        s3client().copy_object(
+            Bucket=bucket,
+            Key=fname,
+            CopySource={"Bucket": bucket, "Key": fname},
+            ACL="public-read",
+            ContentType="application/pdf",
+            MetadataDirective="REPLACE",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+    return True
+
+
+def file_sha256(fileobj):
+    """
+    Hashes a seekable file-like object, then rewinds it.
+
+    :returns: The hex SHA-256 of the contents.
+    """
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+        sha256.update(chunk)
+    fileobj.seek(0)
+    return sha256.hexdigest()
+
+
+def content_key(sha256):
+    """
+    :returns: The s3 key of a sheet music file with the given SHA-256.
+    """
+    return f"{sha256}.pdf"
+
+
+def s3ul_dedup(fileobj):
+    """
+    Stores a sheet music file under a key derived from its contents, so that
+    uploading the same file twice only stores (and sends) it once.
+
+    If `fileobj` is seekable it is hashed first, and not uploaded at all if
+    s3 already has it. Otherwise it is streamed to a temporary key and then
+    moved into place. A file that s3 already has is touched (see `s3touch`),
+    so that `gc-sheet-music` does not delete it before the song that now
+    refers to it is saved.
+
+    :param fileobj: A readable binary file-like object.
+    :returns: The s3 key of the file.
+    """
+    if fileobj.seekable():
+        key = content_key(file_sha256(fileobj))
+        if not s3touch(key):
+            s3ul_stream(fileobj, key)
+        return key
+
+    tmp = f"uploads/{uuid.uuid4()}.pdf"
+    sha256, _ = s3ul_stream(fileobj, tmp)
+    key = content_key(sha256)
+    if s3touch(key):
+        s3del(tmp)
+    else:
+        s3rename(tmp, key)
+    return key
+
+
+def s3del(fname):
+    """
+    Deletes a file from s3.
+    """
+    s3del_many([fname])
+
+
+def s3del_many(fnames, batch_size=1000):
+    """
+    Deletes many files from s3, up to `batch_size` (at most 1000, the s3
+    limit) per request.
+
+    :param fnames: An iterable of keys.
+    :returns: The number of files deleted.
+    """
+    fnames = list(fnames)
+    deleted = 0
+    for i in range(0, len(fnames), batch_size):
+        batch = fnames[i : i + batch_size]
+        resp = s3client().delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+        )
+        errors = resp.get("Errors", [])
+        for e in errors:
+            log.warning(f"Could not delete {e['Key']}: {e['Message']}")
+        deleted += len(batch) - len(errors)
+    return deleted
+
+
+def s3download_many(fnames, root, max_workers=S3_MAX_POOL_CONNECTIONS):
+    """
+    Downloads many files from s3 in parallel, each to `root / key`. Files
+    that are already there are skipped, as are files that s3 does not have.
+
+    :param fnames: An iterable of keys.
+    :returns: The number of files downloaded.
+    """
+    root = Path(root)
+
+    def download(key):
+        target = root / key
+        if target.exists():
+            return False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}")
+        try:
+            s3client().download_file(bucket, key, str(tmp))
+        except BaseException as e:
+            tmp.unlink(missing_ok=True)
+            missing = isinstance(e, ClientError) and e.response["Error"][
+                "Code"
+            ] in ("404", "NoSuchKey")
+            if not missing:
+                raise
+            log.warning(f"{key} is not on s3; skipping it.")
+            return False
+        os.replace(tmp, target)
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return sum(pool.map(download, fnames))
+
+
+def s3list():
+    """
+    Yields the metadata of every file in the bucket.
+    """
+    paginator = s3client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket):
+        yield from page.get("Contents", [])
+
+
+def s3rename(old, new):
+    """
+    Renames a file on s3.
+    """
+    s3client().copy_object(
+        Bucket=bucket,
+        Key=new,
+        CopySource={"Bucket": bucket, "Key": old},
+        ACL="public-read",
+    )
+    s3del(old)
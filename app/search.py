@@ -0,0 +1,223 @@
+"""
+In-process inverted index for searching songs.
+
+Chinese text (names, lyrics) is indexed as character unigrams and bigrams, so
+that any substring of two or more characters can be looked up directly.
+Latin text (pinyin, pinyin initials, English composer names) is indexed as
+lower-cased word tokens together with their prefixes, so that partially-typed
+pinyin matches.
+
+The index is held in memory by each worker process. It is built lazily from
+the database on first use and kept up to date by `save_song`.
+"""
+import re
+import threading
+from collections import defaultdict
+
+from .romanize import initials
+
+# CJK Unified Ideographs (plus Extension A and compatibility ideographs).
+CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]+")
+WORD_RE = re.compile(r"[0-9a-z]+")
+
+# How much a hit in each field counts towards a song's score.
+FIELD_WEIGHTS = {
+    "name": 8.0,
+    "pinyin": 4.0,
+    "initials": 3.0,
+    "composer": 2.0,
+    "copyright": 1.0,
+    "lyrics": 1.0,
+}
+
+# Prefix matches on latin tokens count for less than whole-word matches.
+PREFIX_DISCOUNT = 0.5
+MAX_PREFIX_LEN = 24
+
+
+def index_terms(text):
+    """
+    Yields `(term, weight_multiplier)` pairs for a piece of text to be
+    indexed.
+
+    :param text: The text to be indexed.
+    :type text: `str`
+    """
+    if not text:
+        return
+    text = text.lower()
+    for run in CJK_RE.findall(text):
+        for i, char in enumerate(run):
+            yield char, 1.0
+            if i + 1 < len(run):
+                yield run[i : i + 2], 1.0
+
+    words = WORD_RE.findall(text)
+    # Also index the words joined together, so that "zhumai" finds "zhu mai".
+    if len(words) > 1:
+        words.append("".join(words))
+    for word in words:
+        yield word, 1.0
+        for end in range(1, min(len(word), MAX_PREFIX_LEN + 1)):
+            yield word[:end], PREFIX_DISCOUNT
+
+
+def query_terms(text):
+    """
+    Splits a search query into the terms that all have to match.
+
+    Chinese runs are split into bigrams (a single character is looked up on
+    its own); latin words are looked up as-is, which also matches prefixes.
+
+    :param text: The search query.
+    :type text: `str`
+    :returns: A list of unique terms.
+    :rtype: `list(str)`
+    """
+    text = text.lower()
+    terms = []
+    for run in CJK_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i : i + 2] for i in range(len(run) - 1))
+    terms.extend(w[:MAX_PREFIX_LEN] for w in WORD_RE.findall(text))
+    return list(dict.fromkeys(terms))
+
+
+def song_fields(song):
+    """
+    Extracts the searchable fields of a song.
+
+    :param song: A `Song` object, or anything with the same attributes.
+    :returns: A `dict` of field name to text.
+    """
+    lyrics = song.lyrics or {}
+    return {
+        "name": song.name or "",
+        "pinyin": song.pinyin or "",
+        "initials": initials(song.name or ""),
+        "composer": song.composer or "",
+        "copyright": song.copyright or "",
+        "lyrics": "\n".join(str(v) for v in lyrics.values()),
+    }
+
+
+class SongIndex(object):
+    """
+    An inverted index from search term to song ids.
+
+    :attr postings: A mapping of term to `{song_id: weight}`.
+    :attr terms: A mapping of song id to the set of terms it was indexed
+        under, used to remove a song's old postings when it is updated.
+    :attr synced_at: The (naive UTC) time the index is up to date with.
+    :attr checked_at: When the index was last brought up to date, in
+        `time.monotonic()` seconds.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.terms = dict()
+        self.built = False
+        self.synced_at = None
+        self.checked_at = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def clear(self):
+        """
+        Empties the index, so that it gets rebuilt on next use.
+        """
+        with self._lock:
+            self.postings = defaultdict(dict)
+            self.terms = dict()
+            self.built = False
+            self.synced_at = None
+            self.checked_at = None
+
+    def build(self, songs):
+        """
+        Replaces the contents of the index with the given songs.
+
+        :param songs: An iterable of `Song` objects.
+        """
+        with self._lock:
+            self.clear()
+            for song in songs:
+                self.add(song.id, song_fields(song))
+            self.built = True
+
+    def add(self, song_id, fields):
+        """
+        Adds (or replaces) a song in the index.
+
+        :param song_id: The id of the song.
+        :type song_id: `int`
+        :param fields: A `dict` of field name to text, as returned by
+            `song_fields`.
+        """
+        weights = defaultdict(float)
+        for field, text in fields.items():
+            field_weight = FIELD_WEIGHTS.get(field, 1.0)
+            for term, multiplier in index_terms(text):
+                weights[term] = max(weights[term], field_weight * multiplier)
+
+        with self._lock:
+            self.remove(song_id)
+            for term, weight in weights.items():
+                self.postings[term][song_id] = weight
+            self.terms[song_id] = set(weights)
+
+    def update(self, song):
+        """
+        Re-indexes a single `Song` object.
+        """
+        self.add(song.id, song_fields(song))
+
+    def remove(self, song_id):
+        """
+        Removes a song from the index. Does nothing if it is not indexed.
+        """
+        with self._lock:
+            for term in self.terms.pop(song_id, ()):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(song_id, None)
+                    if not posting:
+                        del self.postings[term]
+
+    def search(self, query, limit=50):
+        """
+        Searches the index. Every term in the query has to match for a song
+        to be returned.
+
+        :param query: The search query.
+        :type query: `str`
+        :param limit: The maximum number of results to return.
+        :type limit: `int`
+        :returns: A list of `(song_id, score)` tuples, best match first.
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        with self._lock:
+            postings = [self.postings.get(t, {}) for t in terms]
+            # Intersect starting from the rarest term.
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+                if not candidates:
+                    return []
+            scores = {
+                song_id: sum(p[song_id] for p in postings)
+                for song_id in candidates
+            }
+        ranked = sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))
+        return ranked[:limit]
+
+
+# The index shared by all requests in this process.
+song_index = SongIndex()
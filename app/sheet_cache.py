@@ -0,0 +1,358 @@
+"""
+A bounded on-disk cache of sheet music PDFs downloaded from S3.
+
+- Files are kept under `env.SHEET_CACHE_DIR`, up to `env.SHEET_CACHE_BYTES`
+  in total; the least recently used ones are evicted beyond that. The
+  budget is for the directory, which every worker process shares.
+- Downloads are written to a temporary file and renamed into place, so a
+  partially-written file is never served, even to another worker.
+- Each download is checked against the size and ETag that S3 reports, and
+  the size is checked again whenever a cached file is served.
+
+Uploads can also be put into the cache first and sent to S3 later (see
+`add_file` and `flush`). Until then, they are hard-linked into an `.outbox`
+directory, so that eviction cannot lose them.
+"""
+import fcntl
+import hashlib
+import logging as log
+import os
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+from .env import bucket
+from .s3 import s3client, s3exists, s3touch, s3ul_stream, content_key
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class IntegrityError(IOError):
+    """
+    Raised when a download does not match the object's S3 metadata.
+    """
+
+
+class SheetMusicCache(object):
+    """
+    :attr root: The directory holding the cached files.
+    :attr max_bytes: The byte budget of the cache.
+    :attr entries: An LRU-ordered mapping of key to `(size, etag)`.
+    :attr stats: A `dict` of hit/miss/eviction counters.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, corrupt=0)
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+        self.outbox = self.root / ".outbox"
+        self.outbox.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """
+        Picks up files left by a previous run (or by other workers), least
+        recently used first.
+        """
+        files = [
+            p
+            for p in self.root.iterdir()
+            if p.is_file() and not p.name.startswith(".")
+        ]
+        files.sort(key=lambda p: p.stat().st_atime)
+        for path in files:
+            size = path.stat().st_size
+            self.entries[path.name] = (size, None)
+            self.total_bytes += size
+        self._evict()
+
+    def path(self, key):
+        """
+        :returns: Where `key` is (or would be) cached.
+        """
+        if "/" in key or key.startswith("."):
+            raise ValueError(f"Invalid sheet music key: {key!r}")
+        return self.root / key
+
+    def lookup(self, key):
+        """
+        Returns the path to a cached file without downloading anything.
+
+        :param key: The S3 key of the file.
+        :type key: `str`
+        :returns: The path to the cached file, or `None` if it is not cached.
+        """
+        path = self.path(key)
+        if self._hit(key, path):
+            return path
+        entry = self._adopt(key, path)
+        with self._lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self._store(key, entry)
+        return path
+
+    def get(self, key):
+        """
+        Returns the path to a cached file, downloading it from S3 on a miss.
+
+        :param key: The S3 key of the file.
+        :type key: `str`
+        :returns: The path to the cached file.
+        :rtype: `pathlib.Path`
+        """
+        path = self.lookup(key)
+        if path is not None:
+            return path
+
+        # Only one thread downloads any given key at a time.
+        path = self.path(key)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                if not self._hit(key, path, count=False):
+                    obj = s3client().get_object(Bucket=bucket, Key=key)
+                    for _ in self._receive(key, obj):
+                        pass
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+        return path
+
+    def stream(self, key, obj):
+        """
+        Yields the body of an S3 `get_object` response in chunks, while
+        also writing it into the cache. The file is only added to the cache
+        if the whole body was read and it passes the integrity checks.
+
+        :param key: The S3 key of the file.
+        :param obj: The (complete, not ranged) `get_object` response.
+        """
+        try:
+            yield from self._receive(key, obj)
+        except IntegrityError as e:
+            # The response has already been sent; just don't cache it.
+            log.warning(f"Not caching {key}: {e}")
+        finally:
+            obj["Body"].close()
+
+    def _adopt(self, key, path):
+        """
+        Takes over a file that another worker has already downloaded. Files
+        only ever appear in the cache directory by an atomic rename after
+        they were checked, so they are complete.
+
+        :returns: `(size, etag)`, or `None` if there is no such file.
+        """
+        try:
+            return path.stat().st_size, None
+        except FileNotFoundError:
+            return None
+
+    def _hit(self, key, path, count=True):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            try:
+                size_ok = path.stat().st_size == entry[0]
+                # Other workers evict by access time.
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted by another worker.
+                self._forget(key)
+                return False
+            if not size_ok:
+                # Truncated behind our back.
+                self.stats["corrupt"] += 1
+                self._forget(key)
+                path.unlink(missing_ok=True)
+                return False
+            self.entries.move_to_end(key)
+            if count:
+                self.stats["hits"] += 1
+            return True
+
+    def _receive(self, key, obj):
+        """
+        Streams the body of an S3 `get_object` response into a temporary
+        file, yielding each chunk as it goes. Once the body is complete, it
+        is checked against the size and ETag that S3 reported, renamed into
+        place and added to the cache.
+        """
+        expected_size = obj["ContentLength"]
+        etag = obj.get("ETag", "").strip('"')
+
+        md5 = hashlib.md5()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in obj["Body"].iter_chunks(CHUNK_SIZE):
+                    md5.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+                    yield chunk
+            if size != expected_size:
+                raise IntegrityError(
+                    f"{key}: got {size} bytes, expected {expected_size}"
+                )
+            # Multipart uploads have ETags that are not the MD5 of the file.
+            if etag and "-" not in etag and md5.hexdigest() != etag:
+                raise IntegrityError(f"{key}: checksum does not match ETag")
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        log.debug(f"Cached {key} ({size} bytes).")
+        with self._lock:
+            self._store(key, (size, etag))
+
+    def _store(self, key, entry):
+        """
+        Records a file that is now in the cache directory. Must be called
+        with the lock held.
+        """
+        self._forget(key)
+        self.entries[key] = entry
+        self.total_bytes += entry[0]
+        self._evict(keep=key)
+
+    def _forget(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[0]
+
+    @contextmanager
+    def _dir_lock(self):
+        """
+        Holds an exclusive lock on the cache directory, shared with the other
+        worker processes.
+        """
+        fd = os.open(self.root, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _evict(self, keep=None):
+        """
+        Removes least recently used files until the cache fits its budget.
+        Must be called with the lock held.
+
+        Other workers add files to the same directory, so it is rescanned
+        (under a file lock) rather than trusting this process' own count.
+        """
+        with self._dir_lock():
+            files = []
+            for path in self.root.iterdir():
+                if path.name.startswith("."):
+                    continue
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files.append((st.st_atime_ns, path.name, st.st_size))
+            total = sum(size for _, _, size in files)
+            for _, key, size in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                self._forget(key)
+                self.path(key).unlink(missing_ok=True)
+                total -= size
+                self.stats["evictions"] += 1
+            self.total_bytes = total
+
+    def add_file(self, fileobj):
+        """
+        Adds an uploaded file to the cache under its content key, and marks
+        it as waiting to be sent to S3 by `flush`.
+
+        :param fileobj: A readable binary file-like object.
+        :returns: The content key of the file.
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            key = content_key(sha256.hexdigest())
+            outbox = self.outbox / key
+            if not outbox.exists():
+                os.link(tmp, outbox)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        with self._lock:
+            self._store(key, (size, None))
+        return key
+
+    def pending(self):
+        """
+        :returns: The keys of files added by `add_file` that have not been
+            sent to S3 yet.
+        """
+        return sorted(p.name for p in self.outbox.iterdir())
+
+    def flush(self, key):
+        """
+        Sends a file added by `add_file` to S3, unless S3 already has it.
+
+        :param key: The content key returned by `add_file`.
+        """
+        outbox = self.outbox / key
+        try:
+            if not s3touch(key):
+                with open(outbox, "rb") as f:
+                    s3ul_stream(f, key)
+            outbox.unlink()
+        except FileNotFoundError:
+            # Sent by an earlier attempt or another worker, unless the file
+            # was lost (e.g. the job ran on another machine); then fail, so
+            # that the job is retried and reported.
+            if not s3exists(key):
+                raise FileNotFoundError(
+                    f"{key} is neither in {self.outbox} nor on S3"
+                )
+
+    def discard(self, key):
+        """
+        Removes a file from the cache, e.g. after it was deleted from S3.
+        """
+        if "/" in key or key.startswith("."):
+            return
+        with self._lock:
+            self._forget(key)
+            self.path(key).unlink(missing_ok=True)
+
+    def info(self):
+        """
+        :returns: The counters plus the current size of the cache.
+        """
+        with self._lock:
+            return dict(
+                self.stats,
+                files=len(self.entries),
+                bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+            )
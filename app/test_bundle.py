@@ -0,0 +1,47 @@
+import zipfile
+from io import BytesIO
+
+from .bundle import minify_css, minify_js
+
+
+def test_minify_css():
+    css = "/* c */\n@import url(https://x/y);\n.a  .b :hover {\n  color : red ;\n}"
+    assert minify_css(css) == ".a .b :hover{color : red;}"
+
+
+def test_minify_js():
+    js = "/**\n * doc\n */\nfunction f() {\n    // note\n    return 1;\n}\n"
+    assert minify_js(js) == "function f() {\nreturn 1;\n}"
+
+
+def test_slides_bundle(client, make_song):
+    make_song(1, "主愛我", lyrics={"A": "主愛我", "B": "我愛祢"})
+    make_song(2, "奇異恩典", lyrics={"V": "奇異恩典"})
+    resp = client.get("/slides/bundle?ids=2,1,99&arr=;B")
+    zf = zipfile.ZipFile(BytesIO(resp.data))
+    assert sorted(zf.namelist()) == [
+        "index.html",
+        "songs/1.html",
+        "songs/2.html",
+    ]
+    index = zf.read("index.html").decode("utf-8")
+    assert "Reveal.initialize" in index
+    assert "url_for" not in index and "/static/" not in index
+    assert index.index("奇異恩典") < index.index("我愛祢")
+    # Song 1 only gets section B.
+    deck = zf.read("songs/1.html").decode("utf-8")
+    assert 'id="B"' in deck and 'id="A"' not in deck
+
+
+def test_export_slides_command(client, make_song, tmp_path):
+    from app import app
+
+    make_song(1, "主愛我", lyrics={"A": "主愛我"})
+    result = app.test_cli_runner().invoke(
+        args=["export-slides", "1", "--out", str(tmp_path)]
+    )
+    assert "Wrote slides for 1 songs" in result.output
+    assert (tmp_path / "songs" / "1.html").exists()
+
+    result = app.test_cli_runner().invoke(args=["export-slides", "1,x"])
+    assert result.exit_code == 2
@@ -0,0 +1,62 @@
+import gzip
+import io
+
+from .exporter import export_records, gzip_chunks
+from .importer import read_records, validate_record
+
+
+def test_gzip_chunks():
+    chunks = [f"line {i}\n" for i in range(10000)]
+    data = b"".join(gzip_chunks(iter(chunks)))
+    assert gzip.decompress(data).decode() == "".join(chunks)
+
+
+def test_export_round_trips_through_import(client, make_song):
+    from app import Song
+
+    make_song(1, "主愛我", lyrics={"A": "第一段", "B": "第二段"})
+    make_song(2, "奇異恩典", composer="約翰牛頓", lyrics={"A": "恩典"})
+    songs = Song.query.order_by(Song.id).all()
+    for fmt in ["jsonl", "yaml", "text"]:
+        data = "".join(export_records(songs, fmt))
+        records = read_records(io.StringIO(data), fmt)
+        imported = [validate_record(r) for _, r in records]
+        assert [s["name"] for s in imported] == ["主愛我", "奇異恩典"]
+        assert imported[0]["lyrics"] == {"A": "第一段", "B": "第二段"}
+        assert imported[1]["composer"] == "約翰牛頓"
+
+
+def test_text_round_trips_stanzas(client, make_song):
+    from app import Song
+
+    lyrics = {
+        "A": "第一節\n\n第二節",
+        "B": "[Chorus]\n[x\n",
+        "C": "",
+    }
+    make_song(1, "主愛我", lyrics=lyrics)
+    make_song(2, "奇異恩典", lyrics={"A": "恩典\n\n\n平安"})
+    songs = Song.query.order_by(Song.id).all()
+    data = "".join(export_records(songs, "text"))
+    imported = [
+        validate_record(r) for _, r in read_records(io.StringIO(data), "text")
+    ]
+    assert imported[0]["lyrics"] == lyrics
+    assert imported[1]["lyrics"] == {"A": "恩典\n\n\n平安"}
+
+
+def test_export_library(client, make_song, tmp_path):
+    from app import app
+
+    for i in range(1, 4):
+        make_song(i, f"song{i}")
+    resp = client.get("/export?format=jsonl&gzip=1")
+    assert resp.mimetype == "application/gzip"
+    assert "songs.jsonl.gz" in resp.headers["Content-Disposition"]
+    lines = gzip.decompress(resp.get_data()).decode().splitlines()
+    assert len(lines) == 3
+
+    out = tmp_path / "songs.yaml.gz"
+    result = app.test_cli_runner().invoke(args=["export-songs", str(out)])
+    assert result.exit_code == 0
+    assert gzip.decompress(out.read_bytes()).decode().count("---") == 3
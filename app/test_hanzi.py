@@ -0,0 +1,26 @@
+from hanziconv import HanziConv
+
+from .hanzi import TraditionalConverter
+
+
+def test_matches_hanziconv():
+    text = "我们的主，祂是爱。这首歌里面有面包。"
+    converter = TraditionalConverter()
+    assert converter.convert(text) == HanziConv.toTraditional(text)
+
+
+def test_custom_mapping():
+    converter = TraditionalConverter(custom_mapping={"面": "面", "里": "裡"})
+    assert converter.convert("里面") == "裡面"
+
+
+def test_phrases():
+    converter = TraditionalConverter(phrases={"头发": "頭髮"})
+    assert converter.convert("头发和发展") == "頭髮和發展"
+
+
+def test_convert_many_and_cache():
+    converter = TraditionalConverter()
+    assert converter.convert_many(["爱", "爱", "门"]) == ["愛", "愛", "門"]
+    assert converter.cache_info().hits == 1
+    assert converter.convert("爱".encode("utf-8")) == "愛"
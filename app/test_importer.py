@@ -0,0 +1,103 @@
+import io
+import json
+
+import yaml
+
+from .importer import parse_plaintext, read_records, validate_record
+
+
+def test_plaintext_round_trip():
+    from app import Song
+    from .utils import lyrics_plaintext
+
+    song = Song(
+        name="主愛我",
+        default_arrangement="A,B",
+        composer="某人",
+        copyright="",
+        lyrics={"A": "第一段\n第二行", "B": "第二段"},
+    )
+    record = parse_plaintext("主愛我\n" + lyrics_plaintext(song))
+    assert validate_record(record) == dict(
+        name="主愛我",
+        default_arrangement="A,B",
+        composer="某人",
+        copyright="",
+        lyrics={"A": "第一段\n第二行", "B": "第二段"},
+    )
+
+
+def test_plaintext_sections_keep_blank_lines():
+    header = "主愛我\nA,B\n\n\n\n\n\n\n"
+    text = header + "[A]\n第一節\n\n第二節\n\n[B]\n[[B]\n\n"
+    assert parse_plaintext(text)["lyrics"] == {
+        "A": "第一節\n\n第二節",
+        "B": "[B]",
+    }
+    # Lyrics must not come before the first section.
+    record = parse_plaintext(header + "歌\n[A]\n")
+    assert isinstance(record, ValueError)
+
+
+def test_read_tinydb_yaml():
+    dump = yaml.dump(
+        {
+            "_default": {
+                "1": {"name": "奇異恩典", "lyrics": {"V": "奇異恩典"}},
+                "2": {"name": "主愛我", "lyrics": {}},
+            }
+        }
+    )
+    records = list(read_records(io.BytesIO(dump.encode()), "yaml"))
+    assert [ref for ref, _ in records] == ["song 1", "song 2"]
+    assert records[0][1]["lyrics"] == {"V": "奇異恩典"}
+
+
+def test_import_jsonl(client, make_song):
+    from app import Song
+
+    make_song(1, "主愛我")
+    lines = [
+        {
+            "name": "这是爱",
+            "lyrics": {"A": "这是爱"},
+            "default_arrangement": "A",
+        },
+        {"name": "主爱我"},
+        {"name": "沒有段落", "default_arrangement": "A,B"},
+        {"lyrics": {}},
+        {"name": "奇异恩典", "composer": "约翰牛顿"},
+    ]
+    data = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines)
+    data += "\n{not json\n"
+    resp = client.post(
+        "/import",
+        data={"file": (io.BytesIO(data.encode()), "songs.jsonl")},
+    )
+    report = resp.get_json()
+    assert report["imported"] == 2
+    errors = {e["ref"]: e["error"] for e in report["errors"]}
+    assert sorted(errors) == ["line 2", "line 3", "line 4", "line 6"]
+    assert errors["line 2"] == "A song named 主愛我 exists"
+    assert errors["line 3"] == "Arrangement has unknown sections: ['A', 'B']"
+
+    song = Song.query.filter_by(name="這是愛").one()
+    assert (song.pinyin, song.lyrics) == ("zhe shi ai", {"A": "這是愛"})
+    song = Song.query.filter_by(name="奇異恩典").one()
+    assert song.composer == "約翰牛頓"
+
+
+def test_failed_chunk_reports_each_song_once(client, make_song, monkeypatch):
+    from sqlalchemy.exc import IntegrityError
+
+    import app as app_module
+
+    def clash(songs, prepared=False):
+        raise IntegrityError("INSERT", {}, Exception("name is taken"))
+
+    make_song(1, "主愛我")
+    monkeypatch.setattr(app_module, "create_songs", clash)
+    records = [("line 1", {"name": "主愛我"}), ("line 2", {"name": "新歌"})]
+    report = app_module.import_songs(records).to_dict()
+    assert report["rejected"] == 2
+    assert [e["ref"] for e in report["errors"]] == ["line 1", "line 2"]
@@ -0,0 +1,127 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine
+
+from .jobs import DONE, FAILED, DatabaseJobStore, JobQueue, MemoryJobStore
+
+
+def wait_for(queue, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.status(job_id)
+        if job["status"] in (DONE, FAILED):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def database_store(tmp_path):
+    # A file, so that the worker thread and the test each get their own
+    # connection (and transaction), as separate processes would.
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.sqlite'}")
+    store = DatabaseJobStore(engine)
+    store.create()
+    return store
+
+
+@pytest.fixture(params=["memory", "database"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryJobStore()
+    return database_store(tmp_path)
+
+
+def test_retry_then_succeed(store):
+    queue = JobQueue(store, max_attempts=3, backoff=0.01)
+    calls = []
+
+    @queue.task("flaky")
+    def flaky(n):
+        calls.append(n)
+        if len(calls) < 2:
+            raise IOError("s3 is down")
+
+    job = wait_for(queue, queue.enqueue("flaky", n=1))
+    assert job["status"] == DONE
+    assert job["attempts"] == 2
+    assert calls == [1, 1]
+    queue.shutdown()
+
+
+def test_give_up(store):
+    queue = JobQueue(store, max_attempts=2, backoff=0.01)
+
+    @queue.task("broken")
+    def broken():
+        raise IOError("s3 is down")
+
+    job = wait_for(queue, queue.enqueue("broken"))
+    assert job["status"] == FAILED
+    assert "s3 is down" in job["error"]
+    queue.shutdown()
+
+
+def test_claim_is_exclusive(tmp_path):
+    store = database_store(tmp_path)
+    job_id = store.add("task", {})
+    assert store.claim(job_id)["attempts"] == 1
+    assert store.claim(job_id) is None
+    assert store.queued() == []
+
+
+def test_async_upload(client, make_song, s3, monkeypatch):
+    import io
+
+    import app
+    from app import Song, jobs, sheet_cache
+
+    monkeypatch.setattr(app, "ASYNC_UPLOADS", True)
+    make_song(1, "主愛我")
+    form = {
+        "name": "主愛我",
+        "section-1": "A",
+        "lyrics-1": "主愛我",
+        "file-upload": (io.BytesIO(b"%PDF-1.4 async"), "score.pdf"),
+    }
+    client.post(
+        "/1/sheet_music/upload", data=form, content_type="multipart/form-data"
+    )
+    key = Song.query.get(1).sheet_music
+    # The file is served from the cache straight away.
+    assert sheet_cache.lookup(key) is not None
+
+    job_id = client.get("/jobs").get_json()["jobs"][0]["id"]
+    assert wait_for(jobs, job_id)["status"] == DONE
+    assert client.get(f"/jobs/{job_id}").get_json()["status"] == DONE
+    assert len(client.get("/jobs?limit=-1").get_json()["jobs"]) == 1
+    obj = s3.get_object(Bucket="worship-manager-test", Key=key)
+    assert obj["Body"].read() == b"%PDF-1.4 async"
+    assert not (sheet_cache.outbox / key).exists()
+
+
+def test_outbox_is_sent_after_restart(client, s3, monkeypatch):
+    import io
+
+    import app
+    from app import jobs, sheet_cache
+
+    monkeypatch.setattr(app, "ASYNC_UPLOADS", True)
+    monkeypatch.setattr(app, "JOBS_BACKEND", "memory")
+    # Left behind by a process that stopped before its job ran.
+    key = sheet_cache.add_file(io.BytesIO(b"%PDF-1.4 left over"))
+    monkeypatch.setattr(app, "_uploads_resumed", False)
+
+    job_id = client.get("/jobs").get_json()["jobs"][0]["id"]
+    assert wait_for(jobs, job_id)["status"] == DONE
+    obj = s3.get_object(Bucket="worship-manager-test", Key=key)
+    assert obj["Body"].read() == b"%PDF-1.4 left over"
+    assert sheet_cache.pending() == []
+
+
+def test_flush_of_lost_upload_fails(s3, tmp_path):
+    from .sheet_cache import SheetMusicCache
+
+    cache = SheetMusicCache(tmp_path, max_bytes=1000)
+    with pytest.raises(FileNotFoundError):
+        cache.flush("ab" * 32 + ".pdf")
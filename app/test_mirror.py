@@ -0,0 +1,105 @@
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from sqlalchemy import create_engine, select
+
+from . import mirror as mirror_module
+from .mirror import Mirror
+
+
+def test_changes_and_mirror(client, make_song, tmp_path, monkeypatch):
+    from app import Song
+
+    monkeypatch.setattr(mirror_module, "OVERLAP", timedelta(0))
+    requests = []
+
+    def fetch(since, limit):
+        params = dict(limit=limit, **({"since": since} if since else {}))
+        requests.append(params)
+        return client.get(f"/changes?{urlencode(params)}").get_json()
+
+    for i in range(1, 6):
+        make_song(i, f"song{i}", lyrics={"A": f"lyrics {i}"})
+    engine = create_engine(f"sqlite:///{tmp_path / 'mirror.sqlite'}")
+    mirror = Mirror(engine, Song.__table__, fetch)
+    assert mirror.sync(limit=2) == (5, 0)
+    assert len(requests) == 3
+
+    client.post(
+        "/2/update",
+        data={"name": "renamed", "section-1": "A", "lyrics-1": "new"},
+    )
+    client.post("/3/delete")
+    requests.clear()
+    assert mirror.sync(limit=2) == (1, 1)
+    assert len(requests) == 1
+
+    table = Song.__table__
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(table.c.id, table.c.name, table.c.lyrics).order_by("id")
+        ).all()
+    assert [(id, name) for id, name, _ in rows] == [
+        (1, "song1"),
+        (2, "renamed"),
+        (4, "song4"),
+        (5, "song5"),
+    ]
+    assert rows[1].lyrics == {"A": "new"}
+
+    # Nothing changed since.
+    assert mirror.sync() == (0, 0)
+
+
+def test_delete_reused_id(client, make_song):
+    from app import db, SongTombstone
+
+    make_song(3, "主愛我")
+    assert client.post("/3/delete").status_code == 302
+    make_song(3, "奇異恩典")
+    assert client.post("/3/delete").status_code == 302
+    assert db.session.scalars(db.select(SongTombstone.id)).all() == [3]
+
+
+def test_changes_rejects_bad_cursor(client):
+    assert client.get("/changes?since=yesterday").status_code == 400
+
+
+def test_snapshot_and_offline_mode(
+    client, make_song, s3, tmp_path, monkeypatch
+):
+    import app as app_module
+    from app import app, db, Song
+
+    s3.put_object(Bucket="worship-manager-test", Key="a.pdf", Body=b"%PDF")
+    make_song(1, "主愛我", sheet_music="a.pdf", composer="", copyright="")
+    make_song(2, "奇異恩典", lyrics={"A": "奇異恩典"})
+
+    out = tmp_path / "snapshot.sqlite"
+    files = tmp_path / "files"
+    result = app.test_cli_runner().invoke(
+        args=["snapshot", str(out), "--sheet-music", str(files)]
+    )
+    assert "Copied 2 songs" in result.output
+    assert "Downloaded 1 sheet music files and 0 previews" in result.output
+    assert (files / "a.pdf").read_bytes() == b"%PDF"
+
+    engine = create_engine(f"sqlite:///{out}")
+    table = Song.__table__
+    with engine.connect() as conn:
+        lyrics = conn.execute(
+            select(table.c.lyrics).where(table.c.id == 2)
+        ).scalar()
+    assert lyrics == {"A": "奇異恩典"}
+    assert Mirror(engine, table, fetch=None).cursor().endswith(",2")
+
+    monkeypatch.setattr(app_module, "OFFLINE", True)
+    monkeypatch.setattr(app_module, "SHEET_MUSIC_DIR", str(files))
+    resp = client.get("/1/sheet_music/download")
+    assert resp.get_data() == b"%PDF"
+    assert client.post("/1/update", data={"name": "x"}).status_code == 405
+    # The song page's buttons render without saving.
+    for action in ("slides", "export"):
+        resp = client.post(f"/1/{action}", data={"name": "x"})
+        assert resp.status_code == 200
+    assert db.session.get(Song, 1).name != "x"
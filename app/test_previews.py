@@ -0,0 +1,77 @@
+import shutil
+
+import pytest
+
+from . import previews as previews_module
+from .previews import is_content_key, preview_key, render_preview
+
+BUCKET = "worship-manager-test"
+KEY = "ab" * 32 + ".pdf"
+
+
+def fake_render(pdf_path, jpeg_path, height=400):
+    jpeg_path.write_bytes(b"\xff\xd8 preview of " + pdf_path.read_bytes())
+    return jpeg_path
+
+
+def test_keys():
+    assert preview_key(KEY) == f"previews/{'ab' * 32}.jpg"
+    assert is_content_key(KEY)
+    assert not is_content_key("Amazing Grace.pdf")
+
+
+def test_generate_and_serve(client, make_song, s3, monkeypatch):
+    from app import app, preview_store
+
+    monkeypatch.setattr(previews_module, "render_preview", fake_render)
+    s3.put_object(Bucket=BUCKET, Key=KEY, Body=b"%PDF")
+    make_song(1, "one", sheet_music=KEY)
+
+    preview_store.generate(KEY)
+    obj = s3.get_object(Bucket=BUCKET, Key=preview_key(KEY))
+    assert obj["Body"].read() == b"\xff\xd8 preview of %PDF"
+
+    # Served from S3 once the local copy is gone, e.g. on another worker.
+    preview_store.path(KEY).unlink()
+    response = client.get(f"/previews/{KEY}")
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 31536000
+
+    response = client.get(f"/previews/{'cd' * 32}.pdf")
+    assert response.status_code == 404
+    assert response.cache_control.max_age == preview_store.miss_ttl
+
+    # Previews of sheet music in use are not garbage.
+    result = app.test_cli_runner().invoke(
+        args=["gc-sheet-music", "--grace", "0"]
+    )
+    assert "Deleted 0 files." in result.output
+
+
+@pytest.mark.skipif(
+    shutil.which("pdftoppm") is None, reason="poppler is not installed"
+)
+def test_render_preview(tmp_path):
+    pdf = tmp_path / "score.pdf"
+    pdf.write_bytes(
+        b"%PDF-1.1\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+        b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+        b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 300 400]>>endobj\n"
+        b"trailer<</Root 1 0 R>>\n%%EOF\n"
+    )
+    jpeg = render_preview(pdf, tmp_path / "score.jpg", height=40)
+    assert jpeg.read_bytes()[:2] == b"\xff\xd8"
+
+
+def test_missing_preview_is_remembered(s3, tmp_path):
+    from .previews import PreviewStore
+
+    store = PreviewStore(tmp_path, sheet_cache=None)
+    assert store.get(KEY) is None
+    # Rendered by another worker: not looked for until the miss expires.
+    s3.put_object(Bucket=BUCKET, Key=preview_key(KEY), Body=b"\xff\xd8")
+    assert store.get(KEY) is None
+    store.misses[KEY] = 0
+    assert store.get(KEY).read_bytes() == b"\xff\xd8"
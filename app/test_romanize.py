@@ -0,0 +1,48 @@
+import pinyin
+
+from .romanize import initials, romanize
+
+
+def test_romanize_matches_pinyin_package():
+    for text in ["主愛我", "Amazing Grace 奇異恩典", "您好，世界！"]:
+        expected = pinyin.get(text, format="strip", delimiter=" ")
+        assert romanize(text) == expected
+
+
+def test_initials():
+    assert initials("主買我") == "zmw"
+    assert initials("Amazing Grace 奇異恩典") == "agqyed"
+    assert initials("") == ""
+
+
+def test_fill_pinyin_command(client, make_song):
+    from app import app, Song
+
+    make_song(1, "主愛我", pinyin="")
+    make_song(2, "奇異恩典", pinyin="qi yi en dian")
+    result = app.test_cli_runner().invoke(args=["fill-pinyin"])
+    assert "Updated pinyin for 1 songs." in result.output
+    assert Song.query.get(1).pinyin == "zhu ai wo"
+
+
+def test_fill_pinyin_updates_search_table(client, make_song, monkeypatch):
+    import app as app_module
+    from app import app, db
+    from .db_search import create_search_tables, search_songs, sync_songs
+
+    monkeypatch.setattr(app_module, "SEARCH_BACKEND", "database")
+    song = make_song(1, "主愛我", pinyin="")
+    create_search_tables(db.session)
+    sync_songs(db.session, [song])
+    db.session.commit()
+    assert search_songs(db.session, "zhu ai wo") == []
+
+    app.test_cli_runner().invoke(args=["fill-pinyin"])
+    assert [id for id, _ in search_songs(db.session, "zhu ai wo")] == [1]
+
+
+def test_search_by_initials(client, make_song):
+    make_song(1, "主愛我", pinyin="zhu ai wo")
+    make_song(2, "奇異恩典", pinyin="qi yi en dian")
+    resp = client.get("/search?q=qyed&format=json")
+    assert [r["id"] for r in resp.get_json()["results"]] == [2]
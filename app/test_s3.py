@@ -0,0 +1,119 @@
+from .s3 import s3client, s3del, s3rename, s3ul
+
+BUCKET = "worship-manager-test"
+
+
+def test_client_is_shared(s3):
+    assert s3client() is s3client()
+
+
+def test_upload_rename_delete(s3, tmp_path):
+    src = tmp_path / "score.pdf"
+    src.write_bytes(b"%PDF-1.4 test")
+    s3ul(str(src), "test-old.pdf")
+    s3rename("test-old.pdf", "test-new.pdf")
+
+    obj = s3.get_object(Bucket=BUCKET, Key="test-new.pdf")
+    assert obj["Body"].read() == b"%PDF-1.4 test"
+
+    s3del("test-new.pdf")
+    assert "Contents" not in s3.list_objects_v2(Bucket=BUCKET)
+
+
+def test_presigned_url_cache(s3, monkeypatch):
+    from . import s3 as s3_module
+
+    cache = s3_module.PresignedURLCache(ttl=300)
+    url = cache.get("score.pdf", "主愛我.pdf")
+    assert "score.pdf" in url
+    assert "response-content-disposition" in url
+    assert cache.get("score.pdf", "主愛我.pdf") == url
+
+    # Once a URL gets close to expiring, a new one is signed.
+    now = s3_module.time.monotonic()
+    monkeypatch.setattr(s3_module.time, "monotonic", lambda: now + 250)
+    cache.get("score.pdf", "主愛我.pdf")
+    assert cache.urls[("score.pdf", "主愛我.pdf")][1] == now + 250 + 300
+
+
+def test_download_redirects_to_presigned_url(
+    client, make_song, s3, monkeypatch
+):
+    import app
+
+    monkeypatch.setattr(app, "SHEET_MUSIC_DELIVERY", "presigned")
+    make_song(1, "主愛我", sheet_music="score.pdf", composer="", copyright="")
+    resp = client.get("/1/sheet_music/download")
+    assert resp.status_code == 302
+    assert "score.pdf" in resp.headers["Location"]
+
+
+def test_upload_stream(s3):
+    import hashlib
+    import io
+
+    from .s3 import s3ul_stream
+
+    part_size = 5 * 1024 * 1024
+    for size in [100, 2 * part_size + 123]:
+        data = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+        sha256, n = s3ul_stream(io.BytesIO(data), "big.pdf", part_size)
+        assert (sha256, n) == (hashlib.sha256(data).hexdigest(), size)
+        obj = s3.get_object(Bucket=BUCKET, Key="big.pdf")
+        assert obj["Body"].read() == data
+
+
+def test_upload_sheet_music(client, make_song, s3):
+    import io
+
+    from app import Song
+
+    make_song(1, "主愛我")
+    form = {
+        "name": "主愛我",
+        "section-1": "A",
+        "lyrics-1": "主愛我",
+        "file-upload": (io.BytesIO(b"%PDF-1.4 score"), "score.pdf"),
+    }
+    resp = client.post(
+        "/1/sheet_music/upload",
+        data=form,
+        content_type="multipart/form-data",
+    )
+    assert resp.status_code == 302
+    key = Song.query.get(1).sheet_music
+    obj = s3.get_object(Bucket=BUCKET, Key=key)
+    assert obj["Body"].read() == b"%PDF-1.4 score"
+
+
+def test_dedup_and_gc(client, make_song, s3, monkeypatch):
+    import hashlib
+    import io
+
+    from app import app
+    from .s3 import s3touch, s3ul_dedup
+
+    class Unseekable(io.BytesIO):
+        def seekable(self):
+            return False
+
+    data = b"%PDF-1.4 same score"
+    key = s3ul_dedup(io.BytesIO(data))
+    assert key == hashlib.sha256(data).hexdigest() + ".pdf"
+    assert s3ul_dedup(Unseekable(data)) == key
+    assert s3touch(key) and not s3touch("missing.pdf")
+    s3ul_dedup(io.BytesIO(b"%PDF-1.4 orphan"))
+
+    keys = [o["Key"] for o in s3.list_objects_v2(Bucket=BUCKET)["Contents"]]
+    assert len(keys) == 2
+    # Not the app's: gc must leave it alone.
+    s3.put_object(Bucket=BUCKET, Key="song.db", Body=b"{}")
+
+    make_song(1, "one", sheet_music=key)
+    make_song(2, "two", sheet_music=key)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["gc-sheet-music", "--grace", "0"])
+    assert "2 files, 1 in use (1 shared by several songs)" in result.output
+    assert "Deleted 1 files." in result.output
+    keys = [o["Key"] for o in s3.list_objects_v2(Bucket=BUCKET)["Contents"]]
+    assert sorted(keys) == sorted([key, "song.db"])
@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+from .search import SongIndex, query_terms
+
+
+def song(id, name, pinyin="", composer="", lyrics=None):
+    return SimpleNamespace(
+        id=id,
+        name=name,
+        pinyin=pinyin,
+        composer=composer,
+        copyright="",
+        lyrics=lyrics or {},
+    )
+
+
+songs = [
+    song(1, "主耶穌我愛祢", "zhu ye su wo ai mi", lyrics={"A": "我愛祢勝過一切"}),
+    song(2, "奇異恩典", "qi yi en dian", composer="John Newton"),
+    song(3, "祢的愛", "mi de ai", lyrics={"A": "主耶穌的愛"}),
+]
+
+
+def test_query_terms():
+    assert query_terms("主耶穌") == ["主耶", "耶穌"]
+    assert query_terms("愛") == ["愛"]
+    assert query_terms("Zhu Ye") == ["zhu", "ye"]
+
+
+def test_search_ranks_name_above_lyrics():
+    index = SongIndex()
+    index.build(songs)
+    results = index.search("主耶穌")
+    assert [id for id, _ in results] == [1, 3]
+
+
+def test_search_pinyin_and_prefix():
+    index = SongIndex()
+    index.build(songs)
+    assert [id for id, _ in index.search("qi yi")] == [2]
+    assert [id for id, _ in index.search("qiyi")] == [2]
+    assert [id for id, _ in index.search("newt")] == [2]
+    assert index.search("nothing") == []
+
+
+def test_update_and_remove():
+    index = SongIndex()
+    index.build(songs)
+    index.update(song(2, "新歌", "xin ge"))
+    assert index.search("qi yi") == []
+    assert [id for id, _ in index.search("xin")] == [2]
+
+    index.remove(2)
+    assert index.search("xin") == []
+    assert "xin" not in index.postings
+    assert len(index) == 2
+
+
+def test_database_search_sqlite(client):
+    from app import db
+    from .db_search import create_search_tables, search_songs, sync_songs
+
+    create_search_tables(db.session)
+    sync_songs(db.session, songs)
+    db.session.commit()
+
+    assert [id for id, _ in search_songs(db.session, "主耶穌")] == [1, 3]
+    assert [id for id, _ in search_songs(db.session, "newton")] == [2]
+    assert [id for id, _ in search_songs(db.session, "愛")] == [1, 3]
+
+    # Re-syncing a song replaces its old row.
+    sync_songs(db.session, [song(2, "新歌", "xin ge")])
+    assert search_songs(db.session, "newton") == []
+    assert search_songs(db.session, "") == []
+
+
+def test_postgres_terms():
+    from .db_search import search_query, search_terms
+
+    assert search_terms("主愛我 Zhu") == "主 主愛 愛 愛我 我 zhu"
+    # Queries are split into the same terms; latin ones match prefixes.
+    assert search_query("愛我 zh") == "'愛我' & 'zh':*"
+    assert search_query("主") == "'主'"
@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+from .sheet_cache import IntegrityError, SheetMusicCache
+
+BUCKET = os.environ["S3_BUCKET_NAME"]
+
+
+def cached_files(root):
+    return sorted(p.name for p in root.iterdir() if p.is_file())
+
+
+def put(s3, key, size):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=b"x" * size)
+
+
+def test_hit_miss_and_eviction(s3, tmp_path):
+    for key in ["a.pdf", "b.pdf", "c.pdf"]:
+        put(s3, key, 400)
+    cache = SheetMusicCache(tmp_path, max_bytes=1000)
+
+    assert cache.get("a.pdf").read_bytes() == b"x" * 400
+    cache.get("b.pdf")
+    cache.get("a.pdf")
+    cache.get("c.pdf")  # Evicts b.pdf, the least recently used.
+
+    assert cached_files(tmp_path) == ["a.pdf", "c.pdf"]
+    info = cache.info()
+    assert (info["hits"], info["misses"], info["evictions"]) == (1, 3, 1)
+    assert info["bytes"] == 800
+
+
+def test_budget_is_shared_by_workers(s3, tmp_path):
+    for key in ["a.pdf", "b.pdf", "c.pdf"]:
+        put(s3, key, 400)
+    # Two worker processes using the same directory.
+    first = SheetMusicCache(tmp_path, max_bytes=1000)
+    second = SheetMusicCache(tmp_path, max_bytes=1000)
+
+    first.get("a.pdf")
+    second.get("b.pdf")
+    first.get("c.pdf")  # Evicts a.pdf, although `first` never saw b.pdf.
+
+    assert cached_files(tmp_path) == ["b.pdf", "c.pdf"]
+    assert first.info()["bytes"] == 800
+    assert first.lookup("a.pdf") is None
+
+
+def test_truncated_file_is_downloaded_again(s3, tmp_path):
+    put(s3, "a.pdf", 400)
+    cache = SheetMusicCache(tmp_path, max_bytes=1000)
+    cache.get("a.pdf").write_bytes(b"x" * 10)
+    assert cache.get("a.pdf").stat().st_size == 400
+    assert cache.info()["corrupt"] == 1
+
+
+def test_bad_download_is_not_kept(s3, tmp_path, monkeypatch):
+    put(s3, "a.pdf", 400)
+    cache = SheetMusicCache(tmp_path, max_bytes=1000)
+    get_object = s3.get_object
+
+    def wrong_etag(**kwargs):
+        return dict(get_object(**kwargs), ETag='"0123"')
+
+    monkeypatch.setattr(s3, "get_object", wrong_etag)
+    with pytest.raises(IntegrityError):
+        cache.get("a.pdf")
+    assert cached_files(tmp_path) == []
+
+
+def test_existing_files_are_picked_up(s3, tmp_path):
+    put(s3, "a.pdf", 400)
+    (tmp_path / "a.pdf").write_bytes(b"x" * 400)
+    cache = SheetMusicCache(tmp_path, max_bytes=1000)
+    assert cache.info()["bytes"] == 400
+    cache.get("a.pdf")
+    assert cache.info()["hits"] == 1
+
+
+def test_download_sheet_music(client, make_song, s3):
+    put(s3, "score.pdf", 100)
+    make_song(1, "主愛我", sheet_music="score.pdf", composer="A", copyright="B")
+    resp = client.get("/1/sheet_music/download")
+    assert resp.data == b"x" * 100
+    assert "attachment" in resp.headers["Content-Disposition"]
+
+
+def test_stream_uncached_sheet_music(client, make_song, s3):
+    from app import sheet_cache
+
+    put(s3, "stream.pdf", 300)
+    make_song(1, "主愛我", sheet_music="stream.pdf", composer="", copyright="")
+    sheet_cache.discard("stream.pdf")
+
+    # A ranged request is passed through to s3 and not cached.
+    resp = client.get("/1/sheet_music/download", headers={"Range": "bytes=0-9"})
+    assert resp.status_code == 206
+    assert resp.data == b"x" * 10
+    assert resp.headers["Content-Range"] == "bytes 0-9/300"
+    assert sheet_cache.lookup("stream.pdf") is None
+
+    resp = client.get("/1/sheet_music/download")
+    assert resp.status_code == 200
+    assert resp.data == b"x" * 300
+    assert "filename*=UTF-8''%E4%B8%BB" in resp.headers["Content-Disposition"]
+    etag = resp.headers["ETag"]
+    # The full download was written into the cache on the way.
+    assert sheet_cache.lookup("stream.pdf") is not None
+
+    resp = client.get(
+        "/1/sheet_music/download", headers={"Range": "bytes=290-"}
+    )
+    assert resp.status_code == 206
+    assert len(resp.data) == 10
+
+    sheet_cache.discard("stream.pdf")
+    resp = client.get(
+        "/1/sheet_music/download", headers={"If-None-Match": etag}
+    )
+    assert resp.status_code == 304
+
+    s3.delete_object(Bucket=BUCKET, Key="stream.pdf")
+    sheet_cache.discard("stream.pdf")
+    assert client.get("/1/sheet_music/download").status_code == 404
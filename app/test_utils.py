@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from .utils import (
+    _clean_lyrics,
+    clean_arrangement,
+    clean_lyrics,
+    clean_section,
+)
+
+
+def old_clean_section(lyrics):
+    lyrics = lyrics.strip("。，；：").strip(",.;:")
+    for c in "。，；、.,; ":
+        lyrics = lyrics.replace(c, "　")
+    return lyrics
+
+
+def test_clean_section_matches_chained_replace():
+    for text in ["主愛我，我愛祢。", "a, b; c. d", "；開頭、中間：結尾:", ""]:
+        assert clean_section(text) == old_clean_section(text)
+
+
+def test_clean_lyrics_does_not_mutate_and_caches():
+    song = SimpleNamespace(id=1, lyrics={"A": "主愛我，", "B": "哈利路亞。"})
+    _clean_lyrics.cache_clear()
+    cleaned = clean_lyrics(song)
+    assert cleaned == {"A": "主愛我", "B": "哈利路亞"}
+    assert song.lyrics["A"] == "主愛我，"
+
+    cleaned["A"] = "changed"
+    assert clean_lyrics(song)["A"] == "主愛我"
+    assert _clean_lyrics.cache_info().hits == 1
+
+
+def test_clean_arrangement():
+    assert clean_arrangement("A, B, A, C") == ["A", "B", "A", "C"]
+
+
+def test_slides(client, make_song):
+    make_song(1, "主愛我", lyrics={"A": "主愛我，我愛祢。"})
+    html = client.get("/1/slides").get_data(as_text=True)
+    assert "主愛我　我愛祢" in html
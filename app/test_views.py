@@ -0,0 +1,331 @@
+import pytest
+
+
+def test_view_all_paginates(client, make_song):
+    for i in range(1, 6):
+        make_song(i, f"song{i}")
+
+    resp = client.get("/?limit=2")
+    html = resp.get_data(as_text=True)
+    assert "song1" in html and "song2" in html
+    assert "song3" not in html
+    assert "after=2" in html
+
+    resp = client.get("/?limit=2&after=4")
+    html = resp.get_data(as_text=True)
+    assert "song5" in html
+    assert "song4" not in html
+    assert "下一頁" not in html
+
+
+def test_update_converts_and_is_searchable(client, make_song):
+    make_song(1, "old name")
+    form = {
+        "name": "主爱我",
+        "composer": "",
+        "copyright": "",
+        "ccli": "",
+        "default_arrangement": "A",
+        "youtube": "",
+        "section-1": "A",
+        "lyrics-1": "这是爱",
+    }
+    resp = client.post("/1/update", data=form)
+    assert resp.status_code == 302
+
+    resp = client.get("/search?q=主愛&format=json")
+    results = resp.get_json()["results"]
+    assert [r["id"] for r in results] == [1]
+    assert results[0]["pinyin"] == "zhu ai wo"
+
+    resp = client.get("/search?q=这是")
+    assert "主愛我" in resp.get_data(as_text=True)
+
+
+def test_search_query_is_escaped(client, make_song):
+    make_song(1, "主愛我")
+    html = client.get('/search?q="><script>alert(1)</script>').get_data(
+        as_text=True
+    )
+    assert "<script>alert(1)</script>" not in html
+    assert 'value="&#34;&gt;&lt;script&gt;' in html
+
+
+def test_search_sees_other_workers_edits(client, make_song):
+    from app import db, song_index, Song, SongTombstone, utcnow
+
+    make_song(1, "主愛我")
+    make_song(2, "奇異恩典")
+    assert client.get("/search?q=主愛&format=json").get_json()["results"]
+
+    # Another worker renames song 1 and deletes song 2.
+    db.session.execute(
+        db.update(Song)
+        .where(Song.id == 1)
+        .values(name="這是愛", pinyin="zhe shi ai")
+    )
+    db.session.execute(db.delete(Song).where(Song.id == 2))
+    db.session.add(SongTombstone(id=2, deleted_at=utcnow()))
+    db.session.commit()
+
+    # Not seen until the index is due for a refresh.
+    assert client.get("/search?q=主愛&format=json").get_json()["results"]
+    song_index.checked_at -= 3600
+    search = client.get("/search?q=這是&format=json").get_json()
+    assert [r["id"] for r in search["results"]] == [1]
+    assert song_index.search("奇異") == []
+
+    # Id 2 is reused (e.g. by an old SQLite database).
+    db.session.add(Song(id=2, name="奇妙", lyrics={}))
+    db.session.commit()
+    song_index.checked_at -= 3600
+    search = client.get("/search?q=奇妙&format=json").get_json()
+    assert [r["id"] for r in search["results"]] == [2]
+
+
+def test_slides_etag(client, make_song):
+    from app import slides_cache
+
+    make_song(1, "主愛我", lyrics={"A": "主愛我"})
+    resp = client.get("/1/slides")
+    etag = resp.headers["ETag"]
+    assert resp.status_code == 200
+
+    resp = client.get("/1/slides", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert slides_cache.info()["hits"] == 1
+
+    # Saving the song invalidates the cached slides.
+    slides_cache.bump(1)
+    resp = client.get("/1/slides", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert slides_cache.info()["misses"] == 2
+
+    stats = client.get("/stats/cache").get_json()
+    assert stats["slides"]["size"] == 1
+
+
+def test_setlist_slides(client, make_song):
+    make_song(1, "主愛我", lyrics={"A": "第一段，", "B": "第二段"})
+    make_song(2, "奇異恩典", lyrics={"V": "奇異恩典"})
+    html = client.get("/slides?ids=2,1&arr=;B,A").get_data(as_text=True)
+    assert html.index("奇異恩典") < html.index("第二段") < html.index("第一段")
+    assert "第一段，" not in html
+
+    assert client.get("/slides?ids=3,x").status_code == 400
+    assert client.get("/slides/bundle?ids=3,x").status_code == 400
+
+
+def test_section_routes_query_once(client, make_song, monkeypatch):
+    import app as app_module
+    from app import db, Song
+
+    monkeypatch.setattr(app_module, "QUERY_COUNTER", True)
+    make_song(1, "主愛我")
+    form = {
+        "name": "主愛我",
+        "default_arrangement": "A",
+        "section-1": "A",
+        "lyrics-1": "主愛我",
+    }
+    resp = client.post("/1/add_lyrics_section", data=form)
+    assert resp.headers["X-Query-Count"] == "SELECT=1, UPDATE=1"
+
+    form.update({"section-2": "section-2", "lyrics-2": "section-2"})
+    resp = client.post("/1/remove_lyrics_section/2", data=form)
+    assert resp.headers["X-Query-Count"] == "SELECT=1, UPDATE=1"
+
+    del form["section-2"], form["lyrics-2"]
+    resp = client.post("/1/export", data=form)
+    # Nothing changed, so there is nothing to update.
+    assert resp.headers["X-Query-Count"] == "SELECT=1"
+    assert "主愛我" in resp.get_data(as_text=True)
+
+    db.session.expire_all()
+    assert db.session.get(Song, 1).lyrics == {"A": "主愛我"}
+
+
+def test_query_count_in_debug_mode(client, make_song, monkeypatch):
+    from app import app
+
+    make_song(1, "主愛我")
+    assert "X-Query-Count" not in client.get("/1").headers
+    # Debug mode is switched on after import, as `run.py` does.
+    monkeypatch.setitem(app.config, "DEBUG", True)
+    assert client.get("/1").headers["X-Query-Count"] == "SELECT=1"
+
+
+def test_unchanged_save_is_not_written(client, make_song, monkeypatch):
+    import app as app_module
+    from app import db, slides_cache
+    from app.env import converter
+
+    monkeypatch.setattr(app_module, "QUERY_COUNTER", True)
+    make_song(
+        1,
+        "主愛我",
+        lyrics={"A": "主愛我", "B": "這是愛"},
+        composer="",
+        copyright="",
+        ccli="",
+        youtube="",
+        pinyin="zhu ai wo",
+    )
+    form = {
+        "name": "主愛我",
+        "default_arrangement": "A",
+        "section-1": "A",
+        "lyrics-1": "主愛我",
+        "section-2": "B",
+        "lyrics-2": "这是爱",
+    }
+    converted = []
+    convert_many = converter.convert_many
+
+    def spy(texts):
+        texts = list(texts)
+        converted.extend(texts)
+        return convert_many(texts)
+
+    monkeypatch.setattr(app_module, "convert", lambda t: spy([t])[0])
+    monkeypatch.setattr(converter, "convert_many", spy)
+    resp = client.post("/1/update", data=form)
+    # Only the section that differs from the stored lyrics is converted, and
+    # it converts to what is stored, so nothing is written.
+    assert converted == ["这是爱"]
+    assert resp.headers["X-Query-Count"] == "SELECT=1"
+
+    version = slides_cache.version(1)
+    form["lyrics-2"] = "這是愛！"
+    resp = client.post("/1/update", data=form)
+    assert resp.headers["X-Query-Count"] == "SELECT=1, UPDATE=1"
+    assert slides_cache.version(1) == version + 1
+
+
+def test_concurrent_edits_conflict(client, make_song):
+    from flask import request
+    from sqlalchemy import text
+
+    from app import app, db, ensure_song_index, save_song, SongConflict
+
+    make_song(1, "主愛我")
+    form = {
+        "name": "主愛我",
+        "version": "1",
+        "section-1": "A",
+        "lyrics-1": "第一個人",
+    }
+    assert client.post("/1/update", data=form).status_code == 302
+    # Going back to the saved page and saving again is not a conflict.
+    assert client.post("/1/update", data=form).status_code == 302
+
+    # The second editor loaded the song at version 1 too.
+    form["lyrics-1"] = "第二個人"
+    resp = client.post("/1/update", data=form)
+    assert resp.status_code == 409
+    assert "第一個人" in resp.get_data(as_text=True)
+    resp = client.post(
+        "/1/update", data=form, headers={"Accept": "application/json"}
+    )
+    assert resp.get_json()["song"]["version"] == 2
+    assert resp.get_json()["song"]["lyrics"] == {"A": "第一個人"}
+
+    # Someone else saves between our SELECT and our UPDATE.
+    def concurrent_save(song):
+        with db.session.no_autoflush:
+            db.session.execute(text("UPDATE song SET version = 3"))
+
+    index = ensure_song_index()
+    form["version"] = "2"
+    form["lyrics-1"] = "第三個人"
+    with app.test_request_context(method="POST", data=form):
+        with pytest.raises(SongConflict) as e:
+            save_song(1, request, edit=concurrent_save)
+    # The conflict carries the stored song, not our unsaved edits, and the
+    # rejected edits are not searchable.
+    assert e.value.song.lyrics == {"A": "第一個人"}
+    assert index.search("第三個人") == []
+    assert index.search("第一個人") != []
+
+    form["lyrics-1"] = "第四個人"
+    assert client.post("/1/update", data=form).status_code == 302
+    assert index.search("第四個人") != []
+
+
+def test_previews_do_not_save(client, make_song):
+    from app import db, Song
+
+    make_song(1, "主愛我")
+    form = {
+        "name": "主愛我",
+        "version": "1",
+        "default_arrangement": "A",
+        "section-1": "A",
+        "lyrics-1": "改了一次",
+    }
+    # The slides and export buttons show the form without saving it...
+    assert "改了一次" in client.post("/1/slides", data=form).get_data(
+        as_text=True
+    )
+    assert "改了一次" in client.post("/1/export", data=form).get_data(
+        as_text=True
+    )
+    assert db.session.get(Song, 1).version == 1
+    # ...so that saving the page afterwards is not a conflict.
+    form["lyrics-1"] = "改了兩次"
+    assert client.post("/1/update", data=form).status_code == 302
+    assert db.session.get(Song, 1).lyrics == {"A": "改了兩次"}
+
+
+def test_create_songs(client, make_song):
+    from app import MAX_PAGE_SIZE, Song
+
+    make_song(5, "主愛我")
+    first = client.get("/add")
+    second = client.get("/add")
+    assert first.headers["Location"] != second.headers["Location"]
+    assert Song.query.count() == 3
+
+    resp = client.post(
+        "/songs",
+        json={
+            "songs": [
+                {"name": "这是爱", "lyrics": {"A": "这是爱"}},
+                {"name": "奇异恩典", "composer": "约翰牛顿"},
+            ]
+        },
+    )
+    assert resp.status_code == 201
+    ids = resp.get_json()["ids"]
+    song = Song.query.get(ids[0])
+    assert (song.name, song.pinyin, song.lyrics) == (
+        "這是愛",
+        "zhe shi ai",
+        {"A": "這是愛"},
+    )
+    assert Song.query.get(ids[1]).composer == "約翰牛頓"
+
+    resp = client.post("/songs", json={"count": 3})
+    assert len(set(resp.get_json()["ids"]) | set(ids)) == 5
+
+    # The id of a deleted song is not handed out again.
+    last = max(resp.get_json()["ids"])
+    client.post(f"/{last}/delete")
+    assert client.get("/add").headers["Location"] != f"/{last}"
+
+    resp = client.post("/songs", json={"count": 10**9})
+    assert len(resp.get_json()["ids"]) == MAX_PAGE_SIZE
+
+    for body in [[1], {"count": "x"}, {"songs": 1}]:
+        assert client.post("/songs", json=body).status_code == 400
+    resp = client.post(
+        "/songs", json={"songs": [{"lyrics": "x"}, {"name": 5}, {"name": []}]}
+    )
+    assert resp.status_code == 400
+    assert resp.get_json()["errors"] == [
+        {"ref": "song 1", "error": "lyrics must map section names to text"},
+        {"ref": "song 3", "error": "name must be text"},
+    ]
+
+    resp = client.post("/songs", json={"songs": [{"name": "主愛我"}]})
+    assert resp.status_code == 409
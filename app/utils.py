@@ -1,5 +1,8 @@
-from .env import convert
+from .env import converter
 from flask import request
+from functools import lru_cache
+from urllib.parse import quote
+import unicodedata
 
 class Lyrics(object):
     """
@@ -28,58 +31,84 @@ class Lyrics(object):
         return self.sections
 
 
-def get_lyrics(request: request, exclude_id: int=None):
+def get_lyrics(request: request, exclude_id: int=None, stored: dict=None):
     """
     Utility function that returns a Lyrics object containing the song lyrics.
 
     :param request: `request` object from the Flask app.
     :param exclude_id: an integer identifying which lyrics section to exclude.
+    :param stored: the song's stored lyrics, if any. Sections that are the
+                   same as stored have already been converted, and are not
+                   converted again.
     :returns: A Lyrics object containing the song's lyrics in a structured
               format.
     """
     # Defensive programming checks
     if exclude_id:
         assert isinstance(exclude_id, int)
+    stored = stored or dict()
 
     # Get lyrics
-    lyr = Lyrics()
+    sections = []
     for k, v in request.form.items():
         if "section-" in k:
             idx = int(k.split("-")[-1])
             if idx is not exclude_id:
-                # First, convert to traditional.
-                lyrics = convert(request.form[f"lyrics-{idx}"])
+                sections.append((v, request.form[f"lyrics-{idx}"]))
+
+    # Convert all changed sections to traditional in one batch.
+    changed = [i for i, (s, l) in enumerate(sections) if stored.get(s) != l]
+    converted = converter.convert_many(sections[i][1] for i in changed)
+    for i, lyrics in zip(changed, converted):
+        sections[i] = (sections[i][0], lyrics)
 
-                section = request.form[k]
-                lyr.add_section(section=section, lyrics=lyrics)
+    lyr = Lyrics()
+    for section, lyrics in sections:
+        lyr.add_section(section=section, lyrics=lyrics)
     return lyr
 
 
+# Middle punctuation is replaced with the special blank-space character.
+# The special space character is specified here:
+# https://unicodelookup.com/#%E3%80%80/1
+PUNCTUATION_TABLE = str.maketrans({c: "　" for c in "。，；、.,; "})
+
+
+def clean_section(lyrics):
+    """
+    Cleans the lyrics of one song section for display on slides.
+
+    :example:
+    >>> clean_section("主愛我，我愛祢。")
+    '主愛我　我愛祢'
+
+    :param lyrics: The lyrics of the section.
+    :type lyrics: `str`
+    :returns: The cleaned lyrics.
+    :rtype: `str`
+    """
+    # Strip trailing punctuation except for question marks.
+    lyrics = lyrics.strip("。，；：").strip(",.;:")
+    return lyrics.translate(PUNCTUATION_TABLE)
+
+
+@lru_cache(maxsize=1024)
+def _clean_lyrics(song_id, sections):
+    return {name: clean_section(lyrics) for name, lyrics in sections}
+
+
 def clean_lyrics(song):
     """
     Cleans the lyrics in a song object.
+
+    The song itself is not modified. Cleaned lyrics are cached per song id and
+    lyrics content, so that repeatedly showing the same slides does no text
+    processing.
+
+    :param song: A `Song` object.
+    :returns: A new `dict` of section name to cleaned lyrics.
     """
-    cleaned_lyrics = dict()
-    for name, lyrics in song.lyrics.items():
-        # Strip trailing punctuation except for question marks.
-        lyrics = lyrics.strip("。，；：").strip(',.;:')
-
-        # Replace middle punctuation with special blank-space character.
-        # The special space character is specified here:
-        # https://unicodelookup.com/#%E3%80%80/1
-        lyrics = (
-            lyrics.replace("。", "　")
-            .replace("，", "　")
-            .replace("；", "　")
-            .replace("、", "　")
-            .replace(".", "　")
-            .replace(",", "　")
-            .replace(";", "　")
-            .replace(" ", "　")
-        )
-        cleaned_lyrics[name] = lyrics
-    song.lyrics.update(cleaned_lyrics)
-    return song
+    return dict(_clean_lyrics(song.id, tuple(song.lyrics.items())))
 
 
 def clean_arrangement(arrangement):
@@ -107,6 +136,84 @@ def clean_arrangement(arrangement):
     return arrangement
 
 
+def parse_ids(ids):
+    """
+    Parses a comma-delimited string of song ids.
+
+    :example:
+    >>> parse_ids("3, 17,42")
+    [3, 17, 42]
+
+    :param ids: a comma-delimited string of integers.
+    :type ids: `str`
+    :returns: The ids, in order.
+    :rtype: `list(int)`
+    """
+    return [int(i) for i in ids.split(",") if i.strip()]
+
+
+def parse_arrangements(arr):
+    """
+    Parses the arrangements of a setlist: one comma-delimited arrangement per
+    song, separated by semicolons. An empty arrangement means the song's
+    default arrangement.
+
+    :example:
+    >>> parse_arrangements("V, C; ;A, B")
+    [['V', 'C'], None, ['A', 'B']]
+
+    :param arr: The arrangements.
+    :type arr: `str`
+    :rtype: `list`
+    """
+    if not arr:
+        return []
+    return [
+        clean_arrangement(a) if a.strip() else None for a in arr.split(";")
+    ]
+
+
+def slide_data(song):
+    """
+    Returns the data needed to render a song's slides, with cleaned lyrics.
+
+    :param song: A `Song` object.
+    :rtype: `dict`
+    """
+    return dict(
+        id=song.id,
+        name=song.name,
+        composer=song.composer or "",
+        copyright=song.copyright or "",
+        lyrics=clean_lyrics(song),
+    )
+
+
+SONG_FIELDS = (
+    "id",
+    "version",
+    "name",
+    "pinyin",
+    "composer",
+    "copyright",
+    "ccli",
+    "default_arrangement",
+    "youtube",
+    "sheet_music",
+    "lyrics",
+)
+
+
+def song_dict(song):
+    """
+    Returns a song's stored fields, e.g. for JSON responses.
+
+    :param song: A `Song` object.
+    :rtype: `dict`
+    """
+    return {field: getattr(song, field) for field in SONG_FIELDS}
+
+
 def allowed_file(filename):
     """
     Utility function that checks that the filename has an allowed extension.
@@ -136,11 +243,40 @@ def allowed_file(filename):
     )
 
 
-def lyrics_plaintext(song):
+def content_disposition(filename):
+    """
+    Builds a `Content-Disposition` header that downloads a file under the
+    given name. Non-ASCII names (i.e. most of our song names) are sent as
+    RFC 5987 `filename*`, with an ASCII-only fallback.
+
+    :example:
+    >>> content_disposition("score.pdf")
+    'attachment; filename="score.pdf"'
+
+    :param filename: The name to save the file as.
+    :type filename: `str`
+    :rtype: `str`
+    """
+    simple = unicodedata.normalize("NFKD", filename)
+    simple = simple.encode("ascii", "ignore").decode("ascii")
+    simple = simple.replace("\\", "").replace('"', "")
+    value = f'attachment; filename="{simple}"'
+    if simple != filename:
+        value += f"; filename*=UTF-8''{quote(filename, safe='')}"
+    return value
+
+
+def lyrics_plaintext(song, lyrics=None):
     """
     Get lyrics as plaintext.
+
+    :param song: A `Song` object.
+    :param lyrics: The lyrics to use instead of `song.lyrics`, e.g. as
+        returned by `clean_lyrics`.
     """
     output = ""
+    if lyrics is None:
+        lyrics = song.lyrics
 
     song = validate_song(song)
 
@@ -151,14 +287,42 @@ def lyrics_plaintext(song):
     output += song.copyright
     output += "\n\n"
 
-    for section, lyrics in song.lyrics.items():
+    for section, text in lyrics.items():
         output += section
         output += "\n"
-        output += lyrics
+        output += text
         output += "\n\n"
     return output
 
 
+def keyset_page(query, column, after, limit):
+    """
+    Fetches one page of a query using keyset pagination.
+
+    Rather than using `OFFSET`, which makes the database walk past every
+    skipped row, we filter on `column > after` and order by `column`, so that
+    every page costs the same regardless of how deep into the table it is.
+
+    :param query: A SQLAlchemy query.
+    :param column: The (unique, indexed) column to paginate over.
+    :param after: The value of `column` on the last row of the previous page,
+        or `None` for the first page.
+    :param limit: The maximum number of rows to return.
+    :type limit: `int`
+    :returns: `(rows, next_after)`, where `next_after` is the cursor for the
+        next page, or `None` if this is the last page.
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    # Fetch one extra row to find out whether there is a next page.
+    rows = query.order_by(column).limit(limit + 1).all()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = getattr(rows[-1], column.key)
+    return rows, next_after
+
+
 def validate_song(song):
     """
     Converts song fields from None to '' for string outputs.
@@ -0,0 +1,74 @@
+import os
+import tempfile
+
+import pytest
+
+# The app reads its database URL at import time, so this has to be set before
+# `app` is imported by any of the test modules.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("S3_BUCKET_NAME", "worship-manager-test")
+os.environ.setdefault("SHEET_CACHE_DIR", tempfile.mkdtemp())
+os.environ.setdefault("PREVIEW_DIR", tempfile.mkdtemp())
+
+from app import (  # noqa: E402
+    app as flask_app,
+    db,
+    preview_store,
+    Song,
+    song_index,
+    slides_cache,
+)
+
+
+@pytest.fixture
+def client():
+    flask_app.config["TESTING"] = True
+    song_index.clear()
+    slides_cache.clear()
+    preview_store.misses.clear()
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app.test_client()
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def s3():
+    """
+    Runs the test against an in-memory S3 stand-in (moto), with the sheet
+    music bucket already created.
+    """
+    moto = pytest.importorskip("moto")
+    from app.s3 import reset_s3client, s3client
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        reset_s3client()
+        s3client().create_bucket(Bucket=os.environ["S3_BUCKET_NAME"])
+        yield s3client()
+    reset_s3client()
+
+
+@pytest.fixture
+def make_song(client):
+    """
+    Returns a function that adds a song directly to the database, bypassing
+    the HTML form.
+    """
+    return _make_song
+
+
+def _make_song(id, name, lyrics=None, **kwargs):
+    song = Song(
+        id=id,
+        name=name,
+        lyrics=lyrics or {"A": "lyrics"},
+        default_arrangement="A",
+        **kwargs,
+    )
+    db.session.add(song)
+    db.session.commit()
+    return song
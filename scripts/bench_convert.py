@@ -0,0 +1,71 @@
+"""
+Benchmarks Traditional-Chinese conversion of a song save: every form field
+plus every lyrics section, comparing `HanziConv.toTraditional` with the
+compiled `app.hanzi.TraditionalConverter`.
+
+Usage: python scripts/bench_convert.py [n_songs]
+"""
+import os
+import random
+import sys
+import timeit
+
+from hanziconv import HanziConv
+from hanziconv.charmap import simplified_charmap
+
+sys.path.insert(0, ".")
+# Importing `app` sets up the database; we do not use it here.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+from app.hanzi import TraditionalConverter  # noqa: E402
+from app.env import custom_mapping  # noqa: E402
+
+PUNCTUATION = "，。；、！？ \n"
+
+
+def make_song(rng):
+    """
+    Makes a song with roughly the shape of ours: a handful of short fields and
+    five or six sections of a few hundred characters each.
+    """
+
+    def text(n):
+        chars = [rng.choice(simplified_charmap) for _ in range(n)]
+        for i in range(0, n, 7):
+            chars[i] = rng.choice(PUNCTUATION)
+        return "".join(chars)
+
+    fields = [text(8), text(20), text(10), text(6), text(12)]
+    sections = [text(rng.randint(150, 400)) for _ in range(rng.randint(4, 6))]
+    return fields + sections
+
+
+def main(n_songs=200):
+    rng = random.Random(0)
+    songs = [make_song(rng) for _ in range(n_songs)]
+
+    def old():
+        for song in songs:
+            for t in song:
+                HanziConv.toTraditional(t)
+
+    converter = TraditionalConverter(custom_mapping=custom_mapping)
+
+    def new_cold():
+        converter._cached.cache_clear()
+        for song in songs:
+            converter.convert_many(song)
+
+    def new_warm():
+        for song in songs:
+            converter.convert_many(song)
+
+    for name, fn in [("HanziConv", old), ("compiled", new_cold)]:
+        t = min(timeit.repeat(fn, number=1, repeat=3))
+        print(f"{name:>16}: {t / n_songs * 1e6:10.1f} us per save")
+    new_cold()
+    t = min(timeit.repeat(new_warm, number=1, repeat=3))
+    print(f"{'compiled+cache':>16}: {t / n_songs * 1e6:10.1f} us per save")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))